@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Generates synthetic conf.d trees and times Configuration against them.
+# Results are written as one JSON object per line so runs can be diffed:
+#
+#   python benchmarks/bench.py --sizes 1,100,10000 > before.jsonl
+import argparse
+import gc
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from conf_d import Configuration  # noqa: E402
+
+NAME = 'bench'
+SHAPES = {
+    'narrow': 2,
+    'wide': 50,
+}
+DEFAULTS = dict(('default_%d' % i, 'value_%d' % i) for i in range(20))
+LOOKUPS = 100000
+BULK_KEYS = 4
+RELOAD_PERCENT = 10
+TOUCHES = itertools.count()
+
+
+def digitize(config):
+    for key in config:
+        try:
+            config[key] = int(config[key])
+        except (TypeError, ValueError):
+            pass
+
+    return config
+
+
+def generate_tree(root, files, keys):
+    confd_path = os.path.join(root, 'conf.d')
+    os.makedirs(confd_path)
+
+    with open(os.path.join(root, 'conf'), 'w') as f:
+        f.write('[%s]\n' % NAME)
+
+    for i in range(files):
+        with open(os.path.join(confd_path, 'section_%06d.ini' % i), 'w') as f:
+            f.write('[section_%06d]\n' % i)
+            for k in range(keys):
+                f.write('key_%d: %d\n' % (k, k))
+
+    return os.path.join(root, 'conf'), confd_path
+
+
+def measure(func, setup=None):
+    # tracemalloc slows allocations down a lot, so time and memory are
+    # measured in separate runs. setup runs untimed before each of them
+    if setup is not None:
+        setup()
+    gc.collect()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+
+    result = None
+    if setup is not None:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_parse(kwargs):
+    conf, elapsed, peak = measure(lambda: Configuration(**kwargs))
+    return conf, [('parse', elapsed, peak, 1)]
+
+
+def bench_lookups(conf, sections, keys):
+    results = []
+    names = [sections[i % len(sections)] for i in range(LOOKUPS)]
+    bulk = ['key_%d' % k for k in range(min(keys, BULK_KEYS))]
+
+    def get():
+        for section in names:
+            conf.get(section, 'key_0')
+
+    def has():
+        for section in names:
+            conf.has(section, 'key_0')
+
+    def get_keys():
+        for section in names:
+            for key in bulk:
+                conf.get(section, key)
+
+    def get_many():
+        for section in names:
+            conf.get_many(section, bulk)
+
+    def view():
+        views = dict((section, conf.view(section)) for section in sections)
+        for section in names:
+            config = views[section]
+            for key in bulk:
+                config[key]
+
+    for label, func in (('get', get), ('has', has), ('get_keys', get_keys), ('get_many', get_many), ('view', view)):
+        elapsed, peak = measure(func)[1:]
+        results.append((label, elapsed, peak, LOOKUPS))
+
+    elapsed, peak = measure(conf.raw)[1:]
+    results.append(('raw', elapsed, peak, 1))
+    return results
+
+
+def bench_reloads(conf, confd_path, percent):
+    # Reloads after touching none, one and `percent`% of the conf.d files,
+    # each touch adding a new key so the file's size changes too
+    paths = sorted(os.path.join(confd_path, name) for name in os.listdir(confd_path))
+
+    def touch(count):
+        number = next(TOUCHES)
+        for path in paths[::max(1, len(paths) // count)][:count]:
+            with open(path, 'a') as f:
+                f.write('touched_%d: %d\n' % (number, number))
+
+    results = []
+    for label, count in (('reload_none', 0), ('reload_one', 1), ('reload_%d%%' % percent, max(1, len(paths) * percent // 100))):
+        elapsed, peak = measure(conf.reload, lambda: touch(count) if count else None)[1:]
+        results.append((label, elapsed, peak, 1))
+
+    return results
+
+
+def scenarios(sizes):
+    for files in sizes:
+        for shape, keys in sorted(SHAPES.items()):
+            for defaults in (False, True):
+                for parser in (False, True):
+                    yield files, shape, keys, defaults, parser
+
+
+def set_overrides(files, count):
+    # Overrides key_0 of `count` sections spread over the tree through
+    # BENCH__SECTION__KEY environment variables
+    names = []
+    for i in range(0, files, max(1, files // count)):
+        name = '%s__SECTION_%06d__KEY_0' % (NAME.upper(), i)
+        os.environ[name] = 'override'
+        names.append(name)
+        if len(names) == count:
+            break
+
+    return names
+
+
+def run(sizes, stream, options=None, overrides=0, reload_percent=RELOAD_PERCENT):
+    root = tempfile.mkdtemp(prefix='conf_d-bench-')
+    trees = {}
+    environ = []
+    try:
+        for files, shape, keys, defaults, parser in scenarios(sizes):
+            if (files, keys) not in trees:
+                trees[(files, keys)] = generate_tree(os.path.join(root, '%d-%d' % (files, keys)), files, keys)
+            path, confd_path = trees[(files, keys)]
+
+            kwargs = dict(name=NAME, path=path, confd_path=confd_path)
+            kwargs.update(options or {})
+            if defaults:
+                kwargs['section_defaults'] = DEFAULTS
+            if parser:
+                kwargs['section_parser'] = digitize
+            if overrides:
+                environ = set_overrides(files, overrides)
+                kwargs['env_prefix'] = NAME.upper()
+
+            conf, results = bench_parse(kwargs)
+            for name in environ:
+                del os.environ[name]
+            results.extend(bench_lookups(conf, ['section_%06d' % i for i in range(files)], keys))
+            results.extend(bench_reloads(conf, confd_path, reload_percent))
+
+            for operation, elapsed, peak, iterations in results:
+                stream.write(json.dumps({
+                    'operation': operation,
+                    'files': files,
+                    'shape': shape,
+                    'keys': keys,
+                    'defaults': defaults,
+                    'section_parser': parser,
+                    'options': options or {},
+                    'overrides': len(environ),
+                    'seconds': elapsed,
+                    'per_call': elapsed / iterations,
+                    'peak_bytes': peak,
+                }, sort_keys=True) + '\n')
+            stream.flush()
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark conf_d parsing and lookups.')
+    parser.add_argument('--sizes', default='1,100,10000,100000', help='comma separated numbers of conf.d files')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=JSON', help='extra Configuration argument, e.g. --option workers=4')
+    parser.add_argument('--overrides', type=int, default=0, help='number of sections to override through the environment')
+    parser.add_argument('--reload-percent', type=int, default=RELOAD_PERCENT, help='share of conf.d files to touch in the last reload scenario')
+    parser.add_argument('--output', help='file to write the results to instead of stdout')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    options = {}
+    for option in args.option:
+        name, value = option.split('=', 1)
+        options[name] = json.loads(value)
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            run(sizes, stream, options, args.overrides, args.reload_percent)
+    else:
+        run(sizes, sys.stdout, options, args.overrides, args.reload_percent)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Times what a short lived process pays for conf_d: importing it, building a
+# first Configuration and loading a snapshot. Every run uses a fresh
+# interpreter and results are written as one JSON object per line:
+#
+#   python benchmarks/startup.py --runs 20 > startup.jsonl
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SCRIPTS = {
+    'import': 'import conf_d',
+    'configuration': 'from conf_d import Configuration\n'
+                     'Configuration(name="bench", path=PATH, confd_path=CONFD_PATH)',
+    'snapshot': 'from conf_d import Configuration\n'
+                'Configuration.load_snapshot(SNAPSHOT)',
+}
+
+TIMED = '''import sys, time
+started = time.perf_counter()
+modules = len(sys.modules)
+%s
+sys.stdout.write("%%r %%d" %% (time.perf_counter() - started, len(sys.modules) - modules))
+'''
+
+
+def generate_tree(root, files):
+    confd_path = os.path.join(root, 'conf.d')
+    os.makedirs(confd_path)
+
+    with open(os.path.join(root, 'conf'), 'w') as f:
+        f.write('[bench]\n')
+
+    for i in range(files):
+        with open(os.path.join(confd_path, 'section_%06d.ini' % i), 'w') as f:
+            f.write('[section_%06d]\npath: /var/log/%d.log\n' % (i, i))
+
+    return os.path.join(root, 'conf'), confd_path
+
+
+def import_time():
+    # Cumulative microseconds reported by -X importtime for conf_d itself
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import conf_d'], cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'conf_d':
+            return int(fields[1]) / 1e6
+
+    raise RuntimeError('conf_d missing from -X importtime output')
+
+
+def timed(operation, variables):
+    script = ''.join('%s = %r\n' % item for item in sorted(variables.items())) + SCRIPTS[operation]
+    output = subprocess.run([sys.executable, '-c', TIMED % script], cwd=ROOT, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    seconds, modules = output.split()
+    return float(seconds), int(modules)
+
+
+def summarize(operation, samples, modules, files):
+    samples = sorted(samples)
+    return {
+        'operation': operation,
+        'files': files,
+        'runs': len(samples),
+        'min': samples[0],
+        'median': samples[len(samples) // 2],
+        'modules': modules,
+    }
+
+
+def run(runs, files, stream):
+    root = tempfile.mkdtemp(prefix='conf_d-startup-')
+    try:
+        path, confd_path = generate_tree(root, files)
+        snapshot = os.path.join(root, 'snapshot')
+        sys.path.insert(0, ROOT)
+        from conf_d import Configuration
+        Configuration(name='bench', path=path, confd_path=confd_path).dump_snapshot(snapshot)
+
+        variables = {'PATH': path, 'CONFD_PATH': confd_path, 'SNAPSHOT': snapshot}
+        stream.write(json.dumps(summarize('importtime', [import_time() for i in range(runs)], None, 0), sort_keys=True) + '\n')
+
+        for operation in sorted(SCRIPTS):
+            results = [timed(operation, variables) for i in range(runs)]
+            stream.write(json.dumps(summarize(operation, [seconds for seconds, modules in results], results[0][1], files), sort_keys=True) + '\n')
+            stream.flush()
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark conf_d import and startup time.')
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters per measurement')
+    parser.add_argument('--files', type=int, default=10, help='number of conf.d files to parse')
+    parser.add_argument('--output', help='file to write the results to instead of stdout')
+    args = parser.parse_args()
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            run(args.runs, args.files, stream)
+    else:
+        run(args.runs, args.files, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
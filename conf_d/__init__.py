@@ -1,26 +1,94 @@
 # -*- coding: utf-8 -*-
 import os
+import stat
+from itertools import repeat
 
-from conf_d.compat import ConfigParser
+from conf_d.compat import Mapping, scandir, timer
 
 __version__ = '0.1.0'
 
 
 class Configuration():
 
-    def __init__(self, name, path, parse=True, confd_path=None, conf_ext=None, main_defaults={}, section_defaults={}, main_parser=None, section_parser=None, path_from_main=None, config_parser=ConfigParser):
+    def __init__(self, name, path, parse=True, confd_path=None, conf_ext=None, main_defaults={}, section_defaults={}, main_parser=None, section_parser=None, path_from_main=None, config_parser=None, workers=None, executor=None, cache_dir=None, cache_parsed=False, cache_size=None, lazy=False, share_defaults=False, stats=None, recursive=False, include=None, exclude=None, index=None, main_schema=None, section_schema=None, dedupe=False, provenance=False, tolerant=False, max_errors=None, overrides=None, env_prefix=None):
         self._conf_ext = conf_ext
-        self._config_sections = {}
         self._confd_path = confd_path
+        self._default_confd_path = confd_path
+        self._files = {}
+        self._main_fingerprint = None
+        self._main_sections = {}
+        self._confd_fingerprint = None
+        self._directories = {}
+        self._confd_order = []
+        self._layered = isinstance(confd_path, (list, tuple))
+        self._layers = {}
+        self._own_keys = {}
+        self._indexed = tuple(index or ())
         self._path_from_main = path_from_main
         self._main_config = {}
+        self._generation = _Generation(0, {}, {}, {}, {})
         self._main_defaults = main_defaults
         self._main_parser = main_parser
         self._name = name
         self._path = path
         self._section_defaults = section_defaults
         self._section_parser = section_parser
-        self._config_parser = config_parser
+        self._main_schema = _schema(main_schema)
+        self._section_schema = _schema(section_schema)
+        self._parser_class = config_parser
+        self._executor = executor
+        self._recursive = recursive
+        self._include = _globs(include)
+        self._exclude = _globs(exclude)
+        self._workers = workers
+        self._cache = None
+        self._cache_parsed = cache_parsed
+        self._lazy = lazy
+        self._dedupe = dedupe
+        self._provenance = provenance
+        self._tolerant = tolerant
+        self._max_errors = max_errors
+        self._failures = {}
+        self._overrides = None
+
+        if overrides or env_prefix:
+            from conf_d import overrides as layers
+            optionxform = self._config_parser().optionxform
+            self._overrides = layers.merge(*(layers.normalize(layer, optionxform) for layer in (layers.from_environ(env_prefix) if env_prefix else None, overrides))) or None
+        self._bodies = {}
+
+        if lazy and self._layered:
+            raise ValueError('lazy parsing does not support multiple conf.d directories')
+        if lazy and provenance:
+            raise ValueError('lazy parsing does not support provenance')
+        self._shared_defaults = None
+        self._stats = None
+
+        if stats:
+            from conf_d.stats import ParseStats
+            if isinstance(stats, ParseStats):
+                self._stats = stats
+            elif hasattr(stats, '__call__'):
+                self._stats = ParseStats(stats)
+            else:
+                self._stats = ParseStats()
+
+        if share_defaults:
+            from conf_d.compat import intern
+            self._shared_defaults = dict((intern(key), _intern(value)) for key, value in self._config_parser(section_defaults).defaults().items())
+
+        if cache_dir:
+            from conf_d.cache import ParseCache, cache_token
+            token = cache_token(
+                sorted(section_defaults.items()),
+                _qualified_name(self._config_parser),
+                name,
+                _qualified_name(section_parser) if cache_parsed else None,
+                self._layered,
+                provenance,
+                sorted((section, sorted(config.items())) for section, config in (self._overrides or {}).items())
+            )
+            self._cache = ParseCache(cache_dir, token, max_entries=cache_size)
 
         if self._conf_ext:
             self._conf_ext = '.' + conf_ext.strip(".")
@@ -29,106 +97,1277 @@ class Configuration():
             self.parse()
 
     def get(self, section, key=None, default=None):
+        generation = self._generation
         if section == self._name:
             if key is None:
-                return self._main_config
-            return self._main_config.get(key, default)
+                return generation.main_config
+            return generation.main_config.get(key, default)
 
-        if section in self._config_sections:
+        if section in generation.sections:
             if key is None:
-                return self._config_sections[section]
-            return self._config_sections[section].get(key, default)
+                return self._section(generation, section)
+            return self._section(generation, section).get(key, default)
 
         raise KeyError("Invalid section")
 
+    def get_many(self, section, keys, default=None):
+        config = self.get(section)
+        return list(map(config.get, keys, repeat(default)))
+
+    def view(self, section):
+        # Read-only mapping for callers to hoist out of hot loops; a reload
+        # replaces sections rather than mutating them, so it keeps the values
+        # of the parse it was taken from
+        return _read_only(self.get(section))
+
     def has(self, section, key=None):
-        if section in self._config_sections:
+        generation = self._generation
+        if section in generation.sections:
             if key is None:
                 return True
 
-            return key in self._config_sections[section]
+            return key in self._section(generation, section)
 
         if section == self._name:
             if key is None:
                 return True
 
-            return key in self._main_config
+            return key in generation.main_config
 
         return False
 
-    def raw(self, section=None):
+    def raw(self, section=None, materialize=False):
+        generation = self._generation
         if section:
-            if not self.has(section):
+            if section == self._name:
+                return generation.main_config
+
+            if section not in generation.sections:
                 raise KeyError("Invalid section")
 
-            if section == self._name:
-                return self._main_config
+            if materialize:
+                return dict(self._section(generation, section))
+
+            return self._section(generation, section)
 
-            return self._config_sections[section]
+        if self._lazy:
+            for section in list(generation.sections):
+                self._section(generation, section)
+
+        config_sections = generation.sections
+        if materialize:
+            config_sections = dict((section, dict(config)) for section, config in config_sections.items())
 
         return {
-            self._name: self._main_config,
-            'sections': self._config_sections
+            self._name: generation.main_config,
+            'sections': config_sections
         }
 
+    @property
+    def generation(self):
+        return self._generation.number
+
+    def pin(self):
+        # A copy that keeps reading the current generation; later reloads
+        # only publish new generations to the original
+        import copy
+        pinned = copy.copy(self)
+        pinned._stats = None
+        return pinned
+
+    def find(self, **criteria):
+        generation = self._generation
+        index = self._get_index(generation)
+
+        candidates = None
+        for key, value in criteria.items():
+            if key in index and _hashable(value):
+                matches = index[key].get(value, set())
+                candidates = set(matches) if candidates is None else candidates & matches
+
+        if candidates is None:
+            candidates = list(generation.sections)
+
+        results = {}
+        for section in candidates:
+            config = self._section(generation, section)
+            for key, value in criteria.items():
+                if key not in config or config[key] != value:
+                    break
+            else:
+                results[section] = config
+
+        return results
+
+    def select(self, predicate, key=None):
+        generation = self._generation
+        index = self._get_index(generation)
+        if key in index:
+            results = {}
+            for value, sections in index[key].items():
+                if predicate(value):
+                    for section in sections:
+                        results[section] = generation.sections[section]
+            return results
+
+        sections = dict((section, self._section(generation, section)) for section in list(generation.sections))
+        if key is not None:
+            return dict((section, config) for section, config in sections.items() if key in config and predicate(config[key]))
+
+        return dict((section, config) for section, config in sections.items() if predicate(section, config))
+
+    def _get_index(self, generation):
+        if generation.index is None:
+            if self._lazy and self._indexed:
+                for section in list(generation.sections):
+                    self._section(generation, section)
+            generation.index = self._build_index(generation.sections)
+
+        return generation.index
+
+    def _build_index(self, config_sections):
+        index = dict((key, {}) for key in self._indexed)
+        for section, config in config_sections.items():
+            for key in self._indexed:
+                if key in config and _hashable(config[key]):
+                    index[key].setdefault(config[key], set()).add(section)
+
+        return index
+
+    def source(self, section, key=None):
+        generation = self._generation
+        if section == self._name:
+            return os.path.realpath(self._path)
+
+        if section not in generation.sections:
+            raise KeyError("Invalid section")
+
+        if key is not None and key in generation.key_sources.get(section, ()):
+            return generation.key_sources[section][key]
+
+        return generation.sources[section]
+
+    def origin(self, section, key=None):
+        if not self._provenance:
+            raise ValueError('origin() requires provenance=True')
+
+        generation = self._generation
+        main_path = os.path.realpath(self._path)
+        if section == self._name:
+            definitions, path = [main_path], main_path
+        elif section in generation.sections:
+            definitions, path = generation.definitions[section], self.source(section, key)
+        else:
+            raise KeyError("Invalid section")
+
+        if key is not None and not self.has(section, key):
+            return None
+
+        if key is not None and key in (_override(self._overrides, section) or ()):
+            # Overrides are not read from a file
+            path = None
+
+        found, overrides = None, []
+        for definition in definitions:
+            line = self._line(generation, definition, section, key)
+            if line is None:
+                continue
+
+            location = {'path': definition, 'line': line, 'layer': generation.layers.get(definition)}
+            if definition == path:
+                found = location
+            else:
+                overrides.append(location)
+
+        if found is None:
+            # Set by the defaults passed to Configuration
+            found = {'path': None, 'line': None, 'layer': None}
+
+        found['overrides'] = overrides
+        return found
+
+    def failures(self):
+        return dict(self._failures)
+
+    def _line(self, generation, path, section, key):
+        lines = generation.lines.get(path, {})
+        line = lines.get(section, {}).get(key)
+        if line is None and key is not None:
+            default_section = getattr(self._config_parser, 'default_section', 'DEFAULT')
+            line = lines.get(default_section, {}).get(key)
+
+        return line
+
     def parse(self):
-        configs = self._parse_section(path=self._path, defaults=self._main_defaults, parser=self._main_parser, only_section=self._name)
-        self._main_config = configs.get(self._name)
+        self._reset()
+        self._load()
+
+    def dump_snapshot(self, path):
+        from conf_d import snapshot
+        snapshot.dump(self, path)
+
+    @classmethod
+    def load_snapshot(cls, path, verify=True, **kwargs):
+        from conf_d import snapshot
+        return snapshot.load(cls, path, verify=verify, **kwargs)
+
+    def stats(self, n=10):
+        if self._stats is None:
+            return None
+        return self._stats.summary(n)
+
+    def aparse(self, batch_size=64):
+        from conf_d.aio import aparse
+        return aparse(self, batch_size=batch_size)
+
+    def iter_sections(self, failures=None):
+        # Walks a copy that parses one file at a time and keeps no stats or
+        # shared bodies, so the instance is left as it was
+        import copy
+        walker = copy.copy(self)
+        walker._stats = None
+        walker._bodies = {}
+        walker._workers = walker._executor = None
+        return walker._iter_sections(failures)
+
+    def _iter_sections(self, failures):
+        load = _Load(self._confd_path)
+        main_config, main_sections, load.confd_path = self._read_main(False, load)
+        self._raise_errors(load.errors)
+        path = os.path.realpath(self._path)
+
+        yield path, self._name, main_config
+        for section, config in main_sections.items():
+            yield path, section, config
+
+        confd_files = self._confd_files(load)
+        budget = self._budget(len(confd_files))
+        for path, fingerprint in confd_files:
+            configs = self._parse_eager([path], load)[0]
+            self._raise_errors(load.errors)
+            if path in load.failed:
+                if failures is None:
+                    raise ParseError({path: load.failed[path]})
+
+                failures[path] = load.failed[path]
+                if budget is not None and len(failures) > budget:
+                    raise ParseError(failures)
+                continue
+
+            for section, config in configs.items():
+                yield path, section, config
+
+    def reload(self, paths=None):
+        if paths is not None:
+            paths = set(os.path.realpath(path) for path in paths)
+
+        previous = self._generation
+        self._load(paths)
+        current = self._generation
+
+        added, changed, removed = [], [], []
+        for section, config in current.sections.items():
+            if section not in previous.sections:
+                added.append(section)
+            elif self._changed(previous.sections[section], config, section):
+                changed.append(section)
+
+        for section in previous.sections:
+            if section not in current.sections:
+                removed.append(section)
+
+        if current.main_config is not previous.main_config and current.main_config != previous.main_config:
+            changed.append(self._name)
+
+        return {
+            'added': sorted(added),
+            'changed': sorted(changed),
+            'removed': sorted(removed),
+        }
+
+    def _changed(self, old, new, section):
+        if old is new:
+            return False
+
+        # Lazy sections that were read are compared with their new contents,
+        # the others by the lines they were indexed from
+        old, new = _built(old, section), _built(new, section)
+        if isinstance(old, _Pending):
+            return not isinstance(new, _Pending) or old.digests.get(section) != new.digests.get(section)
+        if isinstance(new, _Pending):
+            try:
+                new = self._build(new, section)
+            except Exception:
+                # Raised again when the section is read
+                return True
+
+        return new != old
+
+    def _reset(self):
+        # Forgets what earlier parses read, so the next load reads everything
+        self._files = {}
+        self._main_fingerprint = None
+        self._bodies = {}
+        if self._stats is not None:
+            self._stats.reset()
 
-        self._config_sections = self._parse_section(path=self._path, defaults=self._section_defaults, parser=self._section_parser, remove_section=self._name)
+    @property
+    def _config_parser(self):
+        if self._parser_class is None:
+            from conf_d.compat import ConfigParser
+            self._parser_class = ConfigParser
 
+        return self._parser_class
+
+    def _load(self, touched=None):
+        load = _Load(self._confd_path)
+        if touched is None or os.path.realpath(self._path) in touched:
+            self._load_main(load)
+
+        confd_files = self._confd_files(load, touched)
+        stale = self._stale(confd_files)
+        parsed = dict(zip(stale, self._parse_files(stale, load)))
+        self._publish(confd_files, parsed, load)
+
+    def _publish(self, confd_files, parsed, load):
+        # Nothing read by this load is kept until all of it has been
+        # accepted, so a failed reload leaves the previous state intact
+        self._raise_errors(load.errors)
+        failures = self._tolerate(confd_files, parsed, load) if self._tolerant else None
+
+        if load.main is not None:
+            self._main_fingerprint, self._main_config, self._main_sections = load.main
+            self._confd_path = load.confd_path
+        if load.scan is not None:
+            self._confd_fingerprint, self._layers, self._directories = load.scan
+        if failures is not None:
+            self._failures = failures
+        self._merge(confd_files, parsed, load)
+
+    def _tolerate(self, confd_files, parsed, load):
+        # Files that failed keep their last good sections, and stay reported
+        # until they parse again or go away
+        present = set(path for path, fingerprint in confd_files)
+        failures = dict((path, error) for path, error in self._failures.items() if path in present and path not in parsed)
+        for path, error in load.failed.items():
+            failures[path] = error
+            if path in self._files:
+                parsed[path] = self._files[path][1]
+
+        budget = self._budget(len(present))
+        if budget is not None and len(failures) > budget:
+            raise ParseError(failures)
+
+        return failures
+
+    def _budget(self, files):
+        if isinstance(self._max_errors, float):
+            return int(self._max_errors * files)
+        return self._max_errors
+
+    def _raise_errors(self, errors):
+        # Schema errors are gathered over the whole parse and reported at once
+        if errors:
+            from conf_d.schema import SchemaError
+            raise SchemaError(errors)
+
+    def _validate(self, schema, path, configs, errors):
+        if schema is None:
+            return configs
+
+        from conf_d.schema import SchemaError
+        validated = {}
+        for section, config in configs.items():
+            try:
+                validated[section] = schema(config)
+            except SchemaError as e:
+                errors.extend((path, section, key, message) for _, _, key, message in e.errors)
+
+        return validated
+
+    def _load_main(self, load):
+        fingerprint = self._fingerprint(self._path)
+        if fingerprint is None or fingerprint != self._main_fingerprint:
+            main_config, main_sections, load.confd_path = self._read_main(self._lazy, load)
+            load.main = (fingerprint, main_config, main_sections)
+
+    def _stale(self, confd_files):
+        stale, seen = [], set()
+        for path, fingerprint in confd_files:
+            if path in seen or (path in self._files and self._files[path][0] == fingerprint):
+                continue
+
+            seen.add(path)
+            stale.append(path)
+
+        return stale
+
+    def _merge(self, confd_files, parsed, load=None):
+        if load is None:
+            load = _Load(self._confd_path)
+
+        files = {}
+        for path, fingerprint in confd_files:
+            if path in parsed:
+                files[path] = (fingerprint, parsed[path])
+            else:
+                files[path] = self._files[path]
+
+        main_path = os.path.realpath(self._path)
+        config_sections = dict(self._main_sections)
+        sources = dict((section, main_path) for section in self._main_sections)
+        key_sources = {}
+
+        if not self._layered:
+            for path, fingerprint in confd_files:
+                configs = files[path][1]
+                config_sections.update(configs)
+                for section in configs:
+                    sources[section] = path
+        else:
+            self._own_keys = dict((path, load.keys[path] if path in load.keys else self._own_keys.get(path, {})) for path in files)
+            self._merge_layers(confd_files, files, config_sections, sources, key_sources)
+
+        definitions, lines = {}, {}
+        if self._provenance:
+            for section in self._main_sections:
+                definitions[section] = [main_path]
+            for path, fingerprint in confd_files:
+                for section in files[path][1]:
+                    definitions.setdefault(section, []).append(path)
+
+            # Files that were not parsed again keep the lines they had
+            previous = self._generation.lines
+            for path in list(files) + [main_path]:
+                if path in load.lines:
+                    lines[path] = load.lines[path]
+                elif path in previous:
+                    lines[path] = previous[path]
+
+        self._files = files
+        self._confd_order = confd_files
+        if self._bodies:
+            # Only bodies still held by a file are kept for later parses
+            held = set(id(config) for configs in [self._main_sections] + [configs for fingerprint, configs in files.values()] for config in configs.values())
+            self._bodies = dict((body, frozen) for body, frozen in self._bodies.items() if id(frozen) in held)
+        if self._stats is not None:
+            self._stats.prune(set(files) | set([main_path]))
+
+        # Everything readers see is built above and published with a
+        # single assignment, so they get either the old or the new state
+        generation = _Generation(self._generation.number + 1, self._main_config, config_sections, sources, key_sources, definitions, lines, self._layers)
+        if self._indexed and not self._lazy:
+            generation.index = self._build_index(config_sections)
+        self._generation = generation
+
+    def _merge_layers(self, confd_files, files, config_sections, sources, key_sources):
+        # Within a directory the last file defining a section wins, across
+        # directories the keys a file sets override those of lower layers
+        layers = []
+        for path, fingerprint in confd_files:
+            layer = self._layers[path]
+            while len(layers) <= layer:
+                layers.append({})
+
+            for section in files[path][1]:
+                layers[layer][section] = path
+
+        defined = set()
+        for layer in layers:
+            for section, path in layer.items():
+                config = files[path][1][section]
+                if section not in defined:
+                    config_sections[section] = config
+                    sources[section] = path
+                    continue
+
+                merged = dict(config_sections[section])
+                merged_sources = key_sources.setdefault(section, dict((key, sources[section]) for key in merged))
+                for key in self._own_keys[path].get(section, config):
+                    if key in config:
+                        merged[key] = config[key]
+                        merged_sources[key] = path
+
+                config_sections[section] = merged
+                sources[section] = path
+
+            defined.update(layer)
+
+    def _section(self, generation, section):
+        config = generation.sections[section]
+        if not isinstance(config, _Pending):
+            return config
+
+        config = self._build(config, section)
+        generation.sections[section] = config
+        return config
+
+    def _build_all(self):
+        # Sections shadowed by another file are never read through the
+        # generation, so they are built here for callers that need them all
+        for configs in [self._main_sections] + [configs for fingerprint, configs in self._files.values()]:
+            for section, config in list(configs.items()):
+                if isinstance(config, _Pending):
+                    self._build(config, section)
+
+    def _build(self, pending, section):
+        config = pending.owner.get(section)
+        if config is not None and not isinstance(config, _Pending):
+            return config
+
+        if pending.configs is None:
+            pending.configs = _parse_file(pending.path, self._parse_options(None))
+
+        config = pending.configs.pop(section, {})
+        if hasattr(self._section_parser, '__call__'):
+            config = self._section_parser(config)
+
+        if self._section_schema is not None:
+            errors = []
+            config = self._validate(self._section_schema, pending.path, {section: config}, errors).get(section, config)
+            self._raise_errors(errors)
+
+        if self._shared_defaults is not None:
+            config = self._share(config)
+
+        if self._dedupe:
+            config = self._freeze(config)
+
+        pending.owner[section] = config
+        return config
+
+    def _freeze(self, config):
+        # Sections with the same body share one read-only mapping
+        try:
+            body = frozenset(config.items())
+        except TypeError:
+            return config
+
+        frozen = self._bodies.get(body)
+        if frozen is None:
+            frozen = self._bodies[body] = _read_only(config)
+
+        return frozen
+
+    def _share(self, config):
+        # Keeps only the keys that differ from the section defaults and
+        # layers them over one mapping shared by every section
+        shared = self._shared_defaults
+        for key in shared:
+            if key not in config:
+                return config
+
+        from conf_d.compat import intern
+        own = {}
+        for key, value in config.items():
+            if key not in shared or shared[key] != value:
+                own[intern(key)] = _intern(value)
+
+        return SectionView(own, shared)
+
+    def _read_main(self, lazy, load):
+        timings = None if self._stats is None else {}
+        lines = {} if self._provenance else None
+        config_parser = _read(self._config_parser, self._path, timings=timings, lines=lines)
+        file_defaults = dict(config_parser.defaults())
+
+        _set_defaults(config_parser, self._main_defaults, file_defaults)
+        configs = _parse_sections(config_parser, defaults=self._main_defaults, parser=self._main_parser, only_section=self._name, timings=timings, overrides=self._overrides)
+        main_config = configs.get(self._name)
+        path = os.path.realpath(self._path)
+        main_config = self._validate(self._main_schema, path, {self._name: main_config}, load.errors).get(self._name, main_config)
+
+        _set_defaults(config_parser, self._section_defaults, file_defaults)
+        if not lazy:
+            main_sections = _parse_sections(config_parser, defaults=self._section_defaults, parser=self._section_parser, remove_section=self._name, timings=timings, overrides=self._overrides)
+            main_sections = self._validate(self._section_schema, path, main_sections, load.errors)
+            if self._shared_defaults is not None:
+                main_sections = dict((section, self._share(config)) for section, config in main_sections.items())
+            if self._dedupe:
+                main_sections = dict((section, self._freeze(config)) for section, config in main_sections.items())
+        else:
+            main_sections = {}
+            configs = _parse_sections(config_parser, defaults=self._section_defaults, remove_section=self._name, overrides=self._overrides)
+            pending = _Pending(self._path, main_sections, configs, dict((section, hash(tuple(sorted(config.items())))) for section, config in configs.items()))
+            for section in pending.configs:
+                main_sections[section] = pending
+
+        if timings is not None:
+            self._stats.clear(path)
+            self._stats.record(path, **timings)
+            self._stats.done(path)
+
+        if lines is not None:
+            load.lines[path] = lines
+
+        confd_path = self._confd_path
         if self._path_from_main:
-            self._confd_path = self._main_config.get(self._path_from_main, self._confd_path)
+            confd_path = main_config.get(self._path_from_main, self._default_confd_path)
+
+        return main_config, main_sections, confd_path
+
+    def _confd_files(self, load, touched=None):
+        directories = {}
+        if self._stats is not None:
+            self._stats.listdir = 0.0
+
+        if not self._layered:
+            load.scan = (self._fingerprint(load.confd_path), {}, directories)
+            return self._scan(load.confd_path, touched, directories)
+
+        files, layers = [], {}
+        for layer, confd_path in enumerate(load.confd_path):
+            for path, fingerprint in self._scan(confd_path, touched, directories):
+                layers[path] = layer
+                files.append((path, fingerprint))
+
+        load.scan = (tuple(self._fingerprint(confd_path) for confd_path in load.confd_path), layers, directories)
+        return files
+
+    def _confd_paths(self):
+        if not self._confd_path:
+            return []
+        if self._layered:
+            return list(self._confd_path)
+        return [self._confd_path]
+
+    def _scan(self, confd_path, touched=None, directories=None):
+        if not confd_path:
+            return []
+
+        if directories is None:
+            directories = {}
+
+        directory = os.path.realpath(confd_path)
+        try:
+            st = os.stat(directory)
+            visited = set([_inode(st)])
+            files = []
+            self._walk(directory, '', files, touched, visited, directories, st)
+        except OSError:
+            return []
+
+        return files
+
+    def _walk(self, directory, prefix, files, touched, visited, directories, st):
+        # Reuses the entry types returned by scandir, so only symlinks need
+        # resolving and only files that may have changed get stat'ed. Each
+        # directory is fingerprinted before it is listed, so snapshots can
+        # tell when a file is added anywhere below conf.d
+        directories[directory] = (st.st_mtime, st.st_size, st.st_ino)
+        started = timer()
+        entries = sorted(scandir(directory), key=lambda entry: entry.name)
+        if self._stats is not None:
+            self._stats.listdir += timer() - started
+
+        for entry in entries:
+            started = timer()
+            relpath = prefix + entry.name
+            path = os.path.realpath(entry.path) if entry.is_symlink() else entry.path
+
+            if entry.is_dir():
+                if not self._recursive or (self._exclude and self._exclude.match(relpath)):
+                    continue
+
+                try:
+                    st = entry.stat()
+                    key = _inode(st)
+                    if key in visited:
+                        continue
+
+                    visited.add(key)
+                    self._walk(path, relpath + '/', files, touched, visited, directories, st)
+                except OSError:
+                    pass
+
+                continue
+
+            if self._conf_ext and not path.endswith(self._conf_ext):
+                continue
+
+            if self._include and not self._include.match(relpath):
+                continue
+
+            if self._exclude and self._exclude.match(relpath):
+                continue
+
+            if touched is not None and path not in touched and path in self._files:
+                files.append((path, self._files[path][0]))
+                continue
 
-        if self._confd_path:
             try:
-                paths = os.listdir(self._confd_path)
+                st = entry.stat()
             except OSError:
-                paths = None
+                continue
+
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            files.append((path, (st.st_mtime, st.st_size, st.st_ino)))
+            if self._stats is not None:
+                self._stats.record(path, scan=timer() - started)
+
+    def _fingerprint(self, path):
+        if not path:
+            return None
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def _parse_files(self, paths, load):
+        if self._lazy:
+            return [self._index_tolerant(path, load) if self._tolerant else self._index(path) for path in paths]
+
+        return self._parse_eager(paths, load)
+
+    def _index_tolerant(self, path, load):
+        try:
+            return self._index(path)
+        except (IOError, OSError, UnicodeError) as e:
+            load.failed[path] = e
+            return {}
+
+    def _parse_eager(self, paths, load):
+        if not self._dedupe:
+            return self._parse_unique(paths, load)
+
+        unique, first, contents, digests = self._identical(paths)
+        results = dict(zip(unique, self._parse_unique(unique, load, contents, digests)))
+        for path in paths:
+            for found in (load.keys, load.lines, load.failed):
+                if first[path] in found:
+                    found[path] = found[first[path]]
+
+        return [results[first[path]] for path in paths]
+
+    def _identical(self, paths):
+        # Maps each path to the first one with the same contents, so files
+        # rendered from the same template are parsed once. The bytes read
+        # for the hash are decoded as open() would and handed to the parser,
+        # and the hash to the parse cache
+        unique, first, seen, contents, digests = [], {}, {}, {}, {}
+        for path in paths:
+            data, digest = _slurp(path)
+            key = path if digest is None else digest
+            if key not in seen:
+                seen[key] = path
+                unique.append(path)
+                if digest is not None:
+                    digests[path] = digest
+                    _decode(path, data, contents)
+            first[path] = seen[key]
+
+        return unique, first, contents, digests
+
+    def _parse_unique(self, paths, load, contents=None, digests=None):
+        results = self._parse_cached(paths, load, contents, digests)
+        if self._section_schema is not None:
+            results = [self._validate(self._section_schema, path, configs, load.errors) for path, configs in zip(paths, results)]
+
+        if self._shared_defaults is not None:
+            results = [dict((section, self._share(config)) for section, config in configs.items()) for configs in results]
+
+        if self._dedupe:
+            results = [dict((section, self._freeze(config)) for section, config in configs.items()) for configs in results]
+
+        return results
+
+    def _parse_cached(self, paths, load, contents=None, digests=None):
+        if self._cache is None:
+            return self._parse_uncached(paths, self._section_parser, load, contents)
+
+        # Each file is read once, its hash checks the cache and on a miss
+        # the same bytes are parsed
+        results, contents = {}, dict(contents or {})
+        for path in paths:
+            data, digest = None, (digests or {}).get(path)
+            if digest is None:
+                data, digest = _slurp(path)
+            results[path] = self._cache.get(path, digest)
+            if results[path] is None and data is not None:
+                _decode(path, data, contents)
+
+        misses = [path for path in paths if results[path] is None]
+        extras = self._layered or self._provenance
+        if extras:
+            for path in paths:
+                if results[path] is not None:
+                    results[path], keys, lines = results[path]
+                    if keys is not None:
+                        load.keys[path] = keys
+                    if lines is not None:
+                        load.lines[path] = lines
+
+        parser = self._section_parser if self._cache_parsed else None
+        for path, configs in zip(misses, self._parse_uncached(misses, parser, load, contents)):
+            if path not in load.failed:
+                self._cache.set(path, (configs, load.keys.get(path), load.lines.get(path)) if extras else configs)
+            results[path] = configs
+        self._cache.prune()
+
+        results = [results[path] for path in paths]
+        if self._cache_parsed or not hasattr(self._section_parser, '__call__'):
+            return results
 
-            if not paths:
-                return
+        return [dict((section, self._section_parser(config)) for section, config in configs.items()) for configs in results]
 
-            for f in sorted(paths):
-                path = os.path.realpath(os.path.join(self._confd_path, f))
-                if not os.path.isfile(path):
+    def _index(self, path):
+        # Only the section headers are read here, the file itself is parsed
+        # the first time one of its sections is accessed
+        from conf_d.compat import ConfigParser
+        sectcre = getattr(self._config_parser, 'SECTCRE', ConfigParser.SECTCRE)
+        default_section = getattr(self._config_parser, 'default_section', 'DEFAULT')
+
+        configs, bodies = {}, {}
+        pending = _Pending(path, configs)
+        body = None
+        with open(path) as f:
+            for line in f:
+                stripped = line.strip()
+                if not stripped or stripped[0] in '#;':
                     continue
 
-                if self._conf_ext and not path.endswith(self._conf_ext):
+                match = None if line[:1].isspace() else sectcre.match(stripped)
+                if match is None:
+                    if body is not None:
+                        body.append(line.rstrip())
                     continue
 
-                configs = self._parse_section(path=path, defaults=self._section_defaults, parser=self._section_parser, remove_section=self._name)
-                self._config_sections.update(configs)
+                section = match.group('header')
+                body = bodies.setdefault(section, [])
+                if section != default_section and section != self._name:
+                    configs[section] = pending
+
+        # The lines of each section, with those of the default section, are
+        # kept hashed so reloads can skip sections nobody has read
+        shared = tuple(bodies.get(default_section, ()))
+        pending.digests = dict((section, hash((shared, tuple(bodies[section])))) for section in configs)
+        return configs
+
+    def _parse_options(self, parser, timed=False, layered=False, located=False, tolerant=False):
+        return _ParseOptions(self._config_parser, self._section_defaults, parser, self._name, timed, layered, located, tolerant, self._overrides)
+
+    def _parse_uncached(self, paths, parser, load, contents=None):
+        timed = self._stats is not None
+        extras = timed or self._layered or self._provenance
+        if not extras and not self._tolerant:
+            return self._parse_with_executor(paths, self._parse_options(parser), contents)
+
+        results = []
+        options = self._parse_options(parser, timed, self._layered, self._provenance, self._tolerant)
+        for path, result in zip(paths, self._parse_with_executor(paths, options, contents)):
+            if isinstance(result, Exception):
+                load.failed[path] = result
+                results.append({})
+                continue
+            if not extras:
+                results.append(result)
+                continue
+
+            configs, timings, keys, lines = result
+            if timings is not None:
+                self._stats.clear(path)
+                self._stats.record(path, **timings)
+                self._stats.done(path)
+            if keys is not None:
+                load.keys[path] = keys
+            if lines is not None:
+                load.lines[path] = lines
+            results.append(configs)
+
+        return results
+
+    def _parse_with_executor(self, paths, options, contents=None):
+        args = (paths, repeat(options))
+        if contents:
+            args += ([contents.get(path) for path in paths],)
+        if not paths or (self._executor is None and not self._workers):
+            return list(map(_parse_file, *args))
+
+        executor = self._executor
+        if executor is None or executor in ('thread', 'process'):
+            from conf_d.compat import ProcessPoolExecutor, ThreadPoolExecutor
+            if ThreadPoolExecutor is None:
+                raise ImportError('Parsing with workers requires concurrent.futures')
+
+            if executor == 'process':
+                executor = ProcessPoolExecutor(self._workers)
+            else:
+                executor = ThreadPoolExecutor(self._workers)
+
+            try:
+                return self._map(executor, args)
+            finally:
+                executor.shutdown()
+
+        return self._map(executor, args)
+
+    def _map(self, executor, args):
+        import multiprocessing
+        from conf_d.compat import ProcessPoolExecutor
+        if ProcessPoolExecutor is not None and isinstance(executor, ProcessPoolExecutor):
+            chunksize = max(1, len(args[0]) // (4 * (self._workers or multiprocessing.cpu_count())))
+            return list(executor.map(_parse_file, *args, chunksize=chunksize))
+
+        return list(executor.map(_parse_file, *args))
 
     def _parse_section(self, path, defaults={}, parser=None, only_section=None, remove_section=None):
-        config_parser = self._config_parser(defaults)
+        config_parser = _read(self._config_parser, path, defaults)
+        return _parse_sections(config_parser, defaults=defaults, parser=parser, only_section=only_section, remove_section=remove_section)
 
-        if not path:
-            raise IOError('No path specified: "%s"' % path)
 
-        path = os.path.realpath(path)
+class ParseError(IOError):
+
+    def __init__(self, errors):
+        self.errors = errors
+        IOError.__init__(self, '%d conf.d files could not be parsed:\n%s' % (len(errors), '\n'.join('%s: %s' % (path, errors[path]) for path in sorted(errors))))
+
+
+class _Load(object):
+    # What one parse has read so far; it only reaches the Configuration once
+    # the whole parse has been accepted
+    __slots__ = ('confd_path', 'main', 'scan', 'errors', 'failed', 'keys', 'lines')
+
+    def __init__(self, confd_path):
+        self.confd_path = confd_path
+        self.main = None
+        self.scan = None
+        self.errors = []
+        self.failed = {}
+        self.keys = {}
+        self.lines = {}
+
+
+class _Generation(object):
+    __slots__ = ('number', 'main_config', 'sections', 'sources', 'key_sources', 'definitions', 'lines', 'layers', 'index')
+
+    def __init__(self, number, main_config, sections, sources, key_sources, definitions=None, lines=None, layers=None):
+        self.number = number
+        self.main_config = main_config
+        self.sections = sections
+        self.sources = sources
+        self.key_sources = key_sources
+        self.definitions = definitions or {}
+        self.lines = lines or {}
+        self.layers = layers or {}
+        self.index = None
+
+
+class SectionView(Mapping):
+    # Read-only view of a section's own keys layered over the defaults
+    # shared by all sections
+    __slots__ = ('_own', '_shared')
+
+    def __init__(self, own, shared):
+        self._own = own
+        self._shared = shared
+
+    def __getitem__(self, key):
+        if key in self._own:
+            return self._own[key]
+        return self._shared[key]
+
+    def __contains__(self, key):
+        return key in self._own or key in self._shared
+
+    def __iter__(self):
+        for key in self._own:
+            yield key
+        for key in self._shared:
+            if key not in self._own:
+                yield key
+
+    def __len__(self):
+        return len(self._own) + sum(1 for key in self._shared if key not in self._own)
+
+    def __repr__(self):
+        return repr(dict(self))
 
-        if len(config_parser.read(path)) != 1:
+    def get(self, key, default=None):
+        if key in self._own:
+            return self._own[key]
+        return self._shared.get(key, default)
+
+
+class _ParseOptions(object):
+    # Everything _parse_file needs besides the path, bundled so that it is
+    # pickled once per task and new options don't widen every signature
+    __slots__ = ('config_parser', 'defaults', 'parser', 'remove_section', 'timed', 'layered', 'located', 'tolerant', 'overrides')
+
+    def __init__(self, config_parser, defaults, parser=None, remove_section=None, timed=False, layered=False, located=False, tolerant=False, overrides=None):
+        self.config_parser = config_parser
+        self.defaults = defaults
+        self.parser = parser
+        self.remove_section = remove_section
+        self.timed = timed
+        self.layered = layered
+        self.located = located
+        self.tolerant = tolerant
+        self.overrides = overrides
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def _built(config, section):
+    if isinstance(config, _Pending):
+        built = config.owner.get(section)
+        if built is not None and not isinstance(built, _Pending):
+            return built
+    return config
+
+
+class _Pending(object):
+    # digests tell reloads whether a section that was never built changed
+    __slots__ = ('path', 'owner', 'configs', 'digests')
+
+    def __init__(self, path, owner, configs=None, digests=None):
+        self.path = path
+        self.owner = owner
+        self.configs = configs
+        self.digests = digests or {}
+
+
+def _globs(patterns):
+    if not patterns:
+        return None
+
+    if isinstance(patterns, str):
+        patterns = [patterns]
+
+    import fnmatch
+    import re
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(pattern) for pattern in patterns))
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _inode(st):
+    return (st.st_dev, st.st_ino)
+
+
+def _intern(value):
+    from conf_d.compat import intern
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+def _qualified_name(obj):
+    if obj is None:
+        return None
+
+    return '%s.%s' % (getattr(obj, '__module__', None), getattr(obj, '__qualname__', getattr(obj, '__name__', repr(obj))))
+
+
+# Module level so that process pools can pickle it by reference
+def _parse_file(path, options, contents=None):
+    if not options.tolerant:
+        return _parse_contents(path, options, contents)
+
+    # Failures are returned rather than raised so that one bad file doesn't
+    # stop a map over the others
+    try:
+        return _parse_contents(path, options, contents)
+    except Exception as e:
+        return e
+
+
+def _parse_contents(path, options, contents=None):
+    config_parser, defaults, overrides = options.config_parser, options.defaults, options.overrides
+    if not options.timed and not options.layered and not options.located:
+        return _parse_sections(_read(config_parser, path, defaults, contents=contents), defaults=defaults, parser=options.parser, remove_section=options.remove_section, overrides=overrides)
+
+    timings = {} if options.timed else None
+    lines = {} if options.located else None
+    keys = None
+    if options.layered:
+        # The keys a file sets itself are needed to merge it over lower layers
+        config_parser = _read(config_parser, path, {}, timings, lines, contents)
+        keys = dict((section, set(config_parser.options(section))) for section in config_parser.sections())
+        for section in keys:
+            keys[section].update(_override(overrides, section) or ())
+        _set_defaults(config_parser, defaults, dict(config_parser.defaults()))
+    else:
+        config_parser = _read(config_parser, path, defaults, timings, lines, contents)
+
+    configs = _parse_sections(config_parser, defaults=defaults, parser=options.parser, remove_section=options.remove_section, timings=timings, overrides=overrides)
+    return configs, timings, keys, lines
+
+
+def _read_only(config):
+    if isinstance(config, SectionView):
+        return config
+
+    from conf_d.compat import MappingProxyType
+    if MappingProxyType is None:
+        return SectionView(config, {})
+
+    return MappingProxyType(config)
+
+
+def _schema(schema):
+    if schema is None or hasattr(schema, '__call__'):
+        return schema
+
+    from conf_d.schema import Schema
+    return Schema(schema)
+
+
+def _set_defaults(config_parser, defaults, file_defaults):
+    # Lets a single read of a file serve several sets of defaults; a
+    # [DEFAULT] section in the file itself still wins
+    shared = config_parser.defaults()
+    shared.clear()
+    shared.update(type(config_parser)(defaults).defaults())
+    shared.update(file_defaults)
+
+
+def _slurp(path):
+    import hashlib
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None, None
+
+    return data, hashlib.sha1(data).hexdigest()
+
+
+def _decode(path, data, contents):
+    import io
+    try:
+        contents[path] = io.TextIOWrapper(io.BytesIO(data)).readlines()
+    except UnicodeError:
+        # Left to the parser to read and report
+        pass
+
+
+def _read(config_parser, path, defaults={}, timings=None, lines=None, contents=None):
+    config_parser = config_parser(defaults)
+
+    if not path:
+        raise IOError('No path specified: "%s"' % path)
+
+    started = timer()
+    path = os.path.realpath(path)
+    realpath = timer()
+
+    if contents is None and lines is not None and hasattr(config_parser, 'read_file'):
+        # The lines read for the parser are also scanned for where each
+        # key is set, so provenance costs no second read of the file
+        try:
+            with open(path) as f:
+                contents = f.readlines()
+        except (IOError, OSError):
             raise IOError('Could not parse config file "%s"' % path)
 
-        configs = {}
-        for section in config_parser.sections():
-            if remove_section and remove_section == section:
-                continue
+    if contents is not None and hasattr(config_parser, 'read_file'):
+        config_parser.read_file(contents, path)
+        if lines is not None:
+            lines.update(_locate(config_parser, contents))
+    elif len(config_parser.read(path)) != 1:
+        raise IOError('Could not parse config file "%s"' % path)
+
+    if timings is not None:
+        timings['realpath'] = timings.get('realpath', 0) + realpath - started
+        timings['read'] = timings.get('read', 0) + timer() - realpath
+
+    return config_parser
 
-            if only_section and only_section != section:
-                continue
 
-            config = dict((x[0], x[1]) for x in config_parser.items(section))
+def _locate(config_parser, contents):
+    from conf_d.compat import ConfigParser
+    sectcre = getattr(config_parser, 'SECTCRE', ConfigParser.SECTCRE)
+
+    lines, section = {}, None
+    for number, line in enumerate(contents, 1):
+        value = line.strip()
+        if not value or value[0] in '#;' or line[0].isspace():
+            continue
+
+        match = sectcre.match(value)
+        if match is not None:
+            section = lines.setdefault(match.group('header'), {})
+            section[None] = number
+            continue
+
+        if section is None:
+            continue
+
+        equals, colon = value.find('='), value.find(':')
+        if equals == -1 or (colon != -1 and colon < equals):
+            equals = colon
+        if equals > 0:
+            section[config_parser.optionxform(value[:equals].rstrip())] = number
+
+    return lines
+
+
+def _override(overrides, section):
+    if not overrides:
+        return None
+    return overrides.get(section.lower())
+
+
+def _parse_sections(config_parser, defaults={}, parser=None, only_section=None, remove_section=None, timings=None, overrides=None):
+    configs = {}
+    for section in config_parser.sections():
+        if remove_section and remove_section == section:
+            continue
+
+        if only_section and only_section != section:
+            continue
+
+        if timings is None:
+            config = dict(config_parser.items(section))
+            override = _override(overrides, section)
+            if override:
+                config.update(override)
             if hasattr(parser, '__call__'):
                 config = parser(config)
 
             configs[section] = config
+            continue
 
-        if only_section and len(configs) == 0:
-            if hasattr(parser, '__call__'):
-                configs[only_section] = parser(defaults)
-            else:
-                configs[only_section] = defaults
+        started = timer()
+        config = dict(config_parser.items(section))
+        override = _override(overrides, section)
+        if override:
+            config.update(override)
+        parsed = timer()
+        timings['items'] = timings.get('items', 0) + parsed - started
+        timings['sections'] = timings.get('sections', 0) + 1
+        timings['keys'] = timings.get('keys', 0) + len(config)
 
-        return configs
+        if hasattr(parser, '__call__'):
+            config = parser(config)
+            timings['section_parser'] = timings.get('section_parser', 0) + timer() - parsed
+
+        configs[section] = config
+
+    if only_section and len(configs) == 0:
+        override = _override(overrides, only_section)
+        if override:
+            defaults = dict(defaults)
+            defaults.update(override)
+        if hasattr(parser, '__call__'):
+            configs[only_section] = parser(defaults)
+        else:
+            configs[only_section] = defaults
+
+    return configs
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+from conf_d import Configuration, _Load
+
+
+async def load(*args, **kwargs):
+    batch_size = kwargs.pop('batch_size', 64)
+    kwargs['parse'] = False
+
+    configuration = Configuration(*args, **kwargs)
+    await aparse(configuration, batch_size=batch_size)
+    return configuration
+
+
+async def aparse(configuration, batch_size=64):
+    loop = asyncio.get_running_loop()
+
+    configuration._reset()
+    load = _Load(configuration._confd_path)
+    await loop.run_in_executor(None, configuration._load_main, load)
+
+    confd_files = await loop.run_in_executor(None, configuration._confd_files, load)
+    stale = configuration._stale(confd_files)
+
+    parsed = {}
+    for i in range(0, len(stale), batch_size):
+        batch = stale[i:i + batch_size]
+        configs = await loop.run_in_executor(None, configuration._parse_files, batch, load)
+        parsed.update(zip(batch, configs))
+
+    configuration._publish(confd_files, parsed, load)
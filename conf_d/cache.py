@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import marshal
+import os
+import pickle
+import tempfile
+
+MARSHAL = b'm'
+PICKLE = b'p'
+
+
+class ParseCache(object):
+
+    def __init__(self, directory, token, max_entries=None):
+        self._directory = directory
+        self._token = token
+        self._max_entries = max_entries
+        self._digests = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, path, digest=None):
+        # digest is the sha1 of the file when the caller already read it
+        try:
+            if digest is None:
+                with open(path, 'rb') as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()
+            st = os.stat(path)
+        except (IOError, OSError):
+            return None
+
+        self._digests[path] = (st.st_mtime, st.st_size, digest)
+
+        entry = self._load(self._entry_path(path))
+        if entry is None:
+            return None
+
+        entry_path, fingerprint, entry_digest, token, configs = entry
+        if entry_path != path or entry_digest != digest or token != self._token:
+            return None
+
+        if fingerprint != (st.st_mtime, st.st_size):
+            self.set(path, configs)
+        else:
+            self._touch(self._entry_path(path))
+
+        return configs
+
+    def set(self, path, configs):
+        if path not in self._digests:
+            return
+
+        mtime, size, digest = self._digests[path]
+        entry = (path, (mtime, size), digest, self._token, configs)
+        try:
+            data = MARSHAL + marshal.dumps(entry)
+        except ValueError:
+            try:
+                data = PICKLE + pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                # Values a section_parser made that can't be stored are
+                # parsed again next time rather than failing this parse
+                return
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, self._entry_path(path))
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def prune(self):
+        if not self._max_entries:
+            return
+
+        entries = []
+        for f in os.listdir(self._directory):
+            if f.startswith('.tmp'):
+                continue
+
+            path = os.path.join(self._directory, f)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+
+        entries.sort()
+        for mtime, path in entries[:max(0, len(entries) - self._max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _entry_path(self, path):
+        return os.path.join(self._directory, hashlib.sha1(path.encode('utf-8')).hexdigest())
+
+    def _load(self, entry_path):
+        try:
+            with open(entry_path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+
+        try:
+            if data[:1] == MARSHAL:
+                return marshal.loads(data[1:])
+            if data[:1] == PICKLE:
+                return pickle.loads(data[1:])
+        except Exception:
+            pass
+
+        return None
+
+    def _touch(self, entry_path):
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+
+
+def cache_token(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
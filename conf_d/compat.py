@@ -2,6 +2,72 @@
 from sys import version_info
 
 if version_info[0] < 3:
+    from collections import Mapping
     from ConfigParser import ConfigParser
+    from time import time as timer
+    intern = intern
+    MappingProxyType = None
 else:
-    from configparser import ConfigParser
+    from collections.abc import Mapping
+    from sys import intern
+    from time import perf_counter as timer
+    MappingProxyType = type(type.__dict__)
+
+LAZY = ('ConfigParser', 'ProcessPoolExecutor', 'ThreadPoolExecutor')
+
+
+def _load(name):
+    if name == 'ConfigParser':
+        from configparser import ConfigParser
+        return ConfigParser
+
+    try:
+        import concurrent.futures
+    except ImportError:
+        return None
+
+    return getattr(concurrent.futures, name)
+
+
+if version_info >= (3, 7):
+    # configparser and concurrent.futures (which pulls in multiprocessing)
+    # are only imported on first use, so that importing conf_d stays cheap
+    def __getattr__(name):
+        if name not in LAZY:
+            raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+        value = globals()[name] = _load(name)
+        return value
+else:
+    if version_info[0] >= 3:
+        ConfigParser = _load('ConfigParser')
+    ProcessPoolExecutor = _load('ProcessPoolExecutor')
+    ThreadPoolExecutor = _load('ThreadPoolExecutor')
+
+try:
+    from os import scandir
+except ImportError:
+    import os
+
+    class DirEntry(object):
+        def __init__(self, directory, name):
+            self.name = name
+            self.path = os.path.join(directory, name)
+            self._stat = None
+
+        def is_dir(self):
+            return os.path.isdir(self.path)
+
+        def is_file(self):
+            return os.path.isfile(self.path)
+
+        def is_symlink(self):
+            return os.path.islink(self.path)
+
+        def stat(self):
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+
+    def scandir(directory):
+        return [DirEntry(directory, name) for name in os.listdir(directory)]
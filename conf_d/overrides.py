@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import os
+
+SEPARATOR = '__'
+
+
+def from_environ(prefix, environ=None, separator=SEPARATOR):
+    # DERP__SYSLOG__PATH=/tmp/log -> {'syslog': {'path': '/tmp/log'}}
+    if environ is None:
+        environ = os.environ
+
+    if not prefix.endswith(separator):
+        prefix += separator
+
+    overrides = {}
+    for name, value in environ.items():
+        if not name.startswith(prefix):
+            continue
+
+        section, found, key = name[len(prefix):].partition(separator)
+        if section and found and key:
+            overrides.setdefault(section.lower(), {})[key.lower()] = value
+
+    return overrides
+
+
+def from_args(args, separator='.'):
+    # ['syslog.path=/tmp/log'] -> {'syslog': {'path': '/tmp/log'}}
+    overrides = {}
+    for arg in args:
+        name, found, value = arg.partition('=')
+        section, dot, key = name.strip().rpartition(separator)
+        if not found or not section or not key:
+            raise ValueError('Invalid override "%s", expected section%skey=value' % (arg, separator))
+
+        overrides.setdefault(section, {})[key] = value
+
+    return overrides
+
+
+def normalize(overrides, optionxform):
+    # Sections match whatever their case in the files, keys are stored the
+    # way the config parser stores them
+    normalized = {}
+    for section, config in (overrides or {}).items():
+        normalized.setdefault(section.lower(), {}).update((optionxform(key), value) for key, value in config.items())
+
+    return normalized
+
+
+def merge(*layers):
+    overrides = {}
+    for layer in layers:
+        for section, config in (layer or {}).items():
+            overrides.setdefault(section, {}).update(config)
+
+    return overrides
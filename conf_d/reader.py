@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from conf_d.compat import ConfigParser
+
+
+class Unsupported(Exception):
+    pass
+
+
+class FastConfigParser(object):
+    # Reads the common INI subset (sections, comments and single line
+    # "key: value" / "key = value" options) straight into dicts, and hands
+    # anything else over to the stdlib ConfigParser
+    SECTCRE = ConfigParser.SECTCRE
+    default_section = 'DEFAULT'
+
+    def __init__(self, defaults=None):
+        self._initial_defaults = defaults or {}
+        self._defaults = {}
+        self._sections = {}
+        self._order = []
+        self._fallback = None
+
+        for key, value in self._initial_defaults.items():
+            if value is not None:
+                value = str(value)
+            self._defaults[self.optionxform(str(key))] = value
+
+    def optionxform(self, optionstr):
+        return optionstr.lower()
+
+    def read(self, filenames):
+        if isinstance(filenames, str):
+            filenames = [filenames]
+
+        read_ok = []
+        for filename in filenames:
+            try:
+                with open(filename) as f:
+                    lines = f.readlines()
+            except (IOError, OSError):
+                continue
+
+            try:
+                self._read(lines)
+            except Unsupported:
+                self._fallback = ConfigParser(self._initial_defaults)
+                return self._fallback.read(filenames)
+
+            read_ok.append(filename)
+
+        return read_ok
+
+    def read_file(self, f, source=None):
+        lines = list(f)
+        try:
+            self._read(lines)
+        except Unsupported:
+            self._fallback = ConfigParser(self._initial_defaults)
+            self._fallback.read_file(lines, source)
+
+    def defaults(self):
+        if self._fallback is not None:
+            return self._fallback.defaults()
+        return self._defaults
+
+    def sections(self):
+        if self._fallback is not None:
+            return self._fallback.sections()
+        return list(self._order)
+
+    def options(self, section):
+        if self._fallback is not None:
+            return self._fallback.options(section)
+
+        options = dict(self._sections[section])
+        options.update(self._defaults)
+        return list(options)
+
+    def items(self, section):
+        if self._fallback is None and self._interpolated():
+            # Defaults can be swapped in after the read, so whether values
+            # need interpolating is only known here
+            self._fallback = ConfigParser(self._defaults)
+            for name in self._order:
+                self._fallback.add_section(name)
+                for key, value in self._sections[name].items():
+                    self._fallback.set(name, key, value)
+
+        if self._fallback is not None:
+            return self._fallback.items(section)
+
+        config = dict(self._defaults)
+        config.update(self._sections[section])
+        return config.items()
+
+    def _interpolated(self):
+        return any(value is not None and '%' in value for value in self._defaults.values())
+
+    def _read(self, lines):
+        section = None
+        for line in lines:
+            value = line.strip()
+            if not value or value[0] in '#;':
+                continue
+
+            if line[0].isspace():
+                raise Unsupported()
+
+            if value[0] == '[':
+                match = self.SECTCRE.match(value)
+                if match is None:
+                    raise Unsupported()
+
+                name = match.group('header')
+                if name == self.default_section or name in self._sections:
+                    raise Unsupported()
+
+                section = self._sections[name] = {}
+                self._order.append(name)
+                continue
+
+            if section is None or '%' in value or ' ;' in value or '\t;' in value:
+                raise Unsupported()
+
+            equals, colon = value.find('='), value.find(':')
+            if equals == -1 or (colon != -1 and colon < equals):
+                equals = colon
+            if equals < 1:
+                raise Unsupported()
+
+            key = self.optionxform(value[:equals].rstrip())
+            if not key or key in section:
+                raise Unsupported()
+
+            section[key] = value[equals + 1:].lstrip()
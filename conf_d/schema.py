@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+BOOLEANS = {
+    '1': True, 'yes': True, 'true': True, 'on': True,
+    '0': False, 'no': False, 'false': False, 'off': False,
+}
+
+
+class SchemaError(ValueError):
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        ValueError.__init__(self, '\n'.join(_format(error) for error in self.errors))
+
+
+class Field(object):
+    __slots__ = ('type', 'default', 'validator', 'required')
+
+    def __init__(self, type=str, default=None, validator=None, required=False):
+        self.type = type
+        self.default = default
+        self.validator = validator
+        self.required = required
+
+
+class Schema(object):
+    # Compiles the fields once into flat tuples, so that a valid section is
+    # converted in a single pass under one try block. Only a section that
+    # fails is walked again key by key to report every error it has.
+
+    def __init__(self, fields):
+        converters, validators, defaults, required = [], [], [], []
+        for key, field in sorted(fields.items()):
+            if not isinstance(field, Field):
+                field = Field(field)
+
+            convert = _boolean if field.type is bool else field.type
+            converters.append((key, field.type, convert))
+            if field.validator is not None:
+                validators.append((key, field.validator))
+            if field.default is not None:
+                defaults.append((key, field.default))
+            elif field.required:
+                required.append(key)
+
+        self.fields = fields
+        self._converters = tuple(converters)
+        self._validators = tuple(validators)
+        self._defaults = tuple(defaults)
+        self._required = tuple(required)
+
+    def __call__(self, config):
+        config = dict(config)
+        try:
+            for key, type, convert in self._converters:
+                if key in config:
+                    value = config[key]
+                    if value.__class__ is not type:
+                        config[key] = convert(value)
+
+            for key, validator in self._validators:
+                if key in config and not validator(config[key]):
+                    raise ValueError()
+
+            for key in self._required:
+                config[key]
+        except (KeyError, TypeError, ValueError):
+            raise SchemaError(self.errors(config))
+
+        for key, default in self._defaults:
+            if key not in config:
+                config[key] = default
+
+        return config
+
+    def errors(self, config):
+        errors = []
+        for key, type, convert in self._converters:
+            if key not in config:
+                continue
+
+            try:
+                if config[key].__class__ is not type:
+                    config[key] = convert(config[key])
+            except (TypeError, ValueError):
+                errors.append((None, None, key, 'invalid %s value %r' % (type.__name__, config[key])))
+
+        invalid = set(error[2] for error in errors)
+        for key, validator in self._validators:
+            if key not in config or key in invalid:
+                continue
+
+            try:
+                valid = validator(config[key])
+            except (TypeError, ValueError) as e:
+                errors.append((None, None, key, str(e)))
+                continue
+
+            if not valid:
+                errors.append((None, None, key, 'failed validation with value %r' % (config[key],)))
+
+        for key in self._required:
+            if key not in config:
+                errors.append((None, None, key, 'missing required key'))
+
+        return errors
+
+
+def _boolean(value):
+    if str(value).lower() not in BOOLEANS:
+        raise ValueError('Not a boolean: %s' % value)
+    return BOOLEANS[str(value).lower()]
+
+
+def _format(error):
+    path, section, key, message = error
+    return '%s [%s] %s: %s' % (path, section, key, message)
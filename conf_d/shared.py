@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import mmap
+import os
+import struct
+import tempfile
+
+VERSION = struct.Struct('Q')
+
+
+class SharedConfiguration(object):
+    # Publishes a parsed Configuration as a snapshot file and bumps a
+    # version counter kept in anonymous shared memory. Processes forked
+    # after construction notice a new version with a plain memory read and
+    # load the new snapshot once, so lookups never take a lock.
+
+    def __init__(self, configuration, path=None):
+        self._configuration = configuration
+        self._owner = os.getpid()
+        self._local = None
+        self._local_version = None
+        self._published = None
+        self._version = mmap.mmap(-1, VERSION.size)
+
+        if path is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            fd, path = tempfile.mkstemp(prefix='conf_d-', suffix='.snapshot', dir=directory)
+            os.close(fd)
+
+        self._path = path
+        self.publish()
+
+    @property
+    def version(self):
+        return VERSION.unpack_from(self._version, 0)[0]
+
+    def publish(self):
+        self._configuration.dump_snapshot(self._path)
+
+        version = self.version + 1
+        VERSION.pack_into(self._version, 0, version)
+        self._published = version
+        return version
+
+    def reload(self, paths=None):
+        diff = self._configuration.reload(paths=paths)
+        if diff['added'] or diff['changed'] or diff['removed']:
+            self.publish()
+
+        return diff
+
+    def get(self, section, key=None, default=None):
+        return self.current().get(section, key, default)
+
+    def has(self, section, key=None):
+        return self.current().has(section, key)
+
+    def raw(self, section=None):
+        return self.current().raw(section)
+
+    def current(self):
+        if os.getpid() == self._owner:
+            return self._configuration
+
+        # A child forked after the last publish still holds an identical
+        # copy of the parsed configuration
+        version = self.version
+        if version == self._published:
+            return self._configuration
+
+        if version != self._local_version:
+            self._local = self._configuration.load_snapshot(self._path, verify=False)
+            self._local_version = version
+
+        return self._local
+
+    def close(self):
+        if os.getpid() == self._owner and os.path.exists(self._path):
+            os.remove(self._path)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import marshal
+import mmap
+import os
+
+MAGIC = b'CONFD1'
+MARSHAL = b'm'
+PICKLE = b'p'
+HEADER_SIZE = len(MAGIC) + 1
+
+
+def dump(configuration, path):
+    configuration._build_all()
+
+    files = {}
+    for file_path, (fingerprint, configs) in configuration._files.items():
+        files[file_path] = (fingerprint, _plain(configs))
+
+    state = {
+        'name': configuration._name,
+        'path': configuration._path,
+        'confd_path': configuration._confd_path,
+        'main_config': dict(configuration._main_config),
+        'main_fingerprint': configuration._main_fingerprint,
+        'main_sections': _plain(configuration._main_sections),
+        'confd_files': configuration._confd_order,
+        'confd_fingerprint': configuration._confd_fingerprint,
+        'directories': configuration._directories,
+        'files': files,
+        'layers': configuration._layers,
+        'own_keys': configuration._own_keys,
+        'lines': configuration._generation.lines,
+    }
+
+    try:
+        data = MAGIC + MARSHAL + marshal.dumps(state)
+    except ValueError:
+        import pickle
+        data = MAGIC + PICKLE + pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    import tempfile
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise IOError('Could not load snapshot "%s"' % path)
+
+    try:
+        if data[:len(MAGIC)] != MAGIC:
+            raise IOError('Could not load snapshot "%s"' % path)
+
+        kind = data[len(MAGIC):HEADER_SIZE]
+        view = memoryview(data)
+        try:
+            if kind == MARSHAL:
+                return marshal.loads(view[HEADER_SIZE:])
+            if kind == PICKLE:
+                import pickle
+                return pickle.loads(view[HEADER_SIZE:])
+        finally:
+            view.release()
+    finally:
+        data.close()
+
+    raise IOError('Could not load snapshot "%s"' % path)
+
+
+def load(cls, path, verify=True, **kwargs):
+    state = read(path)
+    if verify and not is_fresh(state):
+        raise IOError('Snapshot "%s" is stale' % path)
+
+    kwargs.setdefault('confd_path', state['confd_path'])
+    configuration = cls(name=state['name'], path=state['path'], parse=False, **kwargs)
+    configuration._main_config = state['main_config']
+    configuration._main_fingerprint = state['main_fingerprint']
+    configuration._main_sections = state['main_sections']
+    configuration._confd_fingerprint = state['confd_fingerprint']
+    configuration._directories = state.get('directories', {})
+    configuration._layers = state['layers']
+    configuration._own_keys = state['own_keys']
+    configuration._files = dict((file_path, tuple(record)) for file_path, record in state['files'].items())
+
+    from conf_d import _Load
+    load = _Load(configuration._confd_path)
+    load.lines = state.get('lines', {})
+    configuration._merge([(file_path, tuple(fingerprint)) for file_path, fingerprint in state['confd_files']], {}, load)
+    return configuration
+
+
+def is_fresh(state):
+    if state['main_fingerprint'] != _fingerprint(state['path']):
+        return False
+
+    confd_path = state['confd_path']
+    if isinstance(confd_path, (list, tuple)):
+        if state['confd_fingerprint'] != tuple(_fingerprint(path) for path in confd_path):
+            return False
+    elif confd_path and state['confd_fingerprint'] != _fingerprint(confd_path):
+        return False
+
+    for directory, fingerprint in state.get('directories', {}).items():
+        if tuple(fingerprint) != _fingerprint(directory):
+            return False
+
+    for file_path, fingerprint in state['confd_files']:
+        if tuple(fingerprint) != _fingerprint(file_path):
+            return False
+
+    return True
+
+
+def _plain(configs):
+    return dict((section, dict(config)) for section, config in configs.items())
+
+
+def _fingerprint(path):
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return None
+
+    return (st.st_mtime, st.st_size, st.st_ino)
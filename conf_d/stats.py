@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+PHASES = ('scan', 'realpath', 'read', 'items', 'section_parser')
+
+
+class ParseStats(object):
+
+    def __init__(self, callback=None):
+        self._callback = callback
+        self.reset()
+
+    def reset(self):
+        self.files = {}
+        self.listdir = 0.0
+
+    def clear(self, path):
+        # Called before a file is parsed again, keeping only the time the
+        # current scan took to find it
+        stats = self.files.pop(path, None)
+        if stats is not None and 'scan' in stats:
+            self.record(path, scan=stats['scan'])
+
+    def prune(self, paths):
+        for path in list(self.files):
+            if path not in paths:
+                del self.files[path]
+
+    def record(self, path, **timings):
+        stats = self.files.setdefault(path, {'path': path, 'sections': 0, 'keys': 0})
+        stats.update(timings)
+
+        stats['total'] = sum(stats.get(phase, 0.0) for phase in PHASES)
+
+    def done(self, path):
+        if self._callback is not None and path in self.files:
+            self._callback(path, dict(self.files[path]))
+
+    def slowest(self, n=10, key='total'):
+        return sorted(self.files.values(), key=lambda stats: stats.get(key, 0), reverse=True)[:n]
+
+    def summary(self, n=10):
+        totals = dict((phase, 0.0) for phase in PHASES)
+        sections = keys = 0
+        for stats in self.files.values():
+            for phase in PHASES:
+                totals[phase] += stats.get(phase, 0.0)
+            sections += stats['sections']
+            keys += stats['keys']
+
+        totals['listdir'] = self.listdir
+        return {
+            'files': len(self.files),
+            'sections': sections,
+            'keys': keys,
+            'seconds': totals,
+            'total': sum(totals.values()),
+            'slowest': self.slowest(n),
+        }
@@ -1,16 +1,69 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
 from conf_d import Configuration
 from conf_d.compat import ConfigParser
 
+try:
+    from configparser import MissingSectionHeaderError
+except ImportError:
+    from ConfigParser import MissingSectionHeaderError
+
 
 class TestConfigParser(ConfigParser):
     def read(self, path):
         raise NotImplementedError('Catch this')
 
+
+def write_file(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+
+    return True
+
+
+def counting_parser():
+    # A new class per test, so what one test reads doesn't leak into another
+    class CountingConfigParser(ConfigParser):
+        reads = []
+        sources = []
+
+        def read(self, path):
+            CountingConfigParser.reads.append(path)
+            return ConfigParser.read(self, path)
+
+        def read_file(self, f, source=None):
+            CountingConfigParser.sources.append(source)
+            return ConfigParser.read_file(self, f, source)
+
+    return CountingConfigParser
+
+
 class ConfigurationTests(unittest.TestCase):
 
+    def make_tree(self, directories=('conf.d',)):
+        # A temporary directory removed after the test, and the given
+        # directories created inside it
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        paths = [os.path.join(tmp, directory) for directory in directories]
+        for path in paths:
+            os.makedirs(path)
+
+        return [tmp] + paths
+
     def test_invalid_path(self):
         conf = Configuration(
             name='invalid_path',
@@ -449,3 +502,1010 @@ class ConfigurationTests(unittest.TestCase):
             }
         }
         self.assertEqual(expected, conf.raw())
+
+    def test_single_read(self):
+        parser = counting_parser()
+        conf = Configuration(
+            name='default_section',
+            path='./data/default_section.ini',
+            main_defaults={'main_key': 'main_value'},
+            section_defaults={'shared': 'from_defaults', 'section_key': 'section_value'},
+            config_parser=parser
+        )
+        self.assertEqual(1, len(parser.reads))
+
+        expected = conf._parse_section(path='./data/default_section.ini', defaults={'main_key': 'main_value'}, only_section='default_section')
+        self.assertEqual(expected['default_section'], conf.get('default_section'))
+        self.assertEqual({'key': 'from_file', 'main_key': 'main_value', 'shared': 'from_file'}, conf.get('default_section'))
+
+        expected = conf._parse_section(path='./data/default_section.ini', defaults={'shared': 'from_defaults', 'section_key': 'section_value'}, remove_section='default_section')
+        self.assertEqual(expected, conf.raw()['sections'])
+        self.assertEqual({'key': 'value', 'section_key': 'section_value', 'shared': 'from_file'}, conf.get('section'))
+
+    def test_reload(self):
+        tmp, confd_path = self.make_tree()
+        write_file(os.path.join(tmp, 'conf'), '[main]\nkey: value\n')
+        write_file(os.path.join(confd_path, 'a.ini'), '[a]\nkey: value\n')
+        write_file(os.path.join(confd_path, 'b.ini'), '[b]\nkey: value\n')
+
+        parsed = []
+
+        def track(config):
+            parsed.append(dict(config))
+            return config
+
+        conf = Configuration(
+            name='main',
+            path=os.path.join(tmp, 'conf'),
+            confd_path=confd_path,
+            section_parser=track
+        )
+        self.assertEqual(2, len(parsed))
+
+        expected = {'added': [], 'changed': [], 'removed': []}
+        self.assertEqual(expected, conf.reload())
+        self.assertEqual(2, len(parsed))
+
+        write_file(os.path.join(confd_path, 'a.ini'), '[a]\nkey: changed value\n')
+        write_file(os.path.join(confd_path, 'c.ini'), '[c]\nkey: value\n')
+        os.remove(os.path.join(confd_path, 'b.ini'))
+
+        expected = {'added': ['c'], 'changed': ['a'], 'removed': ['b']}
+        self.assertEqual(expected, conf.reload())
+        self.assertEqual(4, len(parsed))
+        self.assertEqual('changed value', conf.get('a', 'key'))
+        self.assertEqual('value', conf.get('c', 'key'))
+        self.assertFalse(conf.has('b'))
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\nkey: other value\n')
+        expected = {'added': [], 'changed': ['main'], 'removed': []}
+        self.assertEqual(expected, conf.reload())
+        self.assertEqual('other value', conf.get('main', 'key'))
+
+    def test_workers(self):
+        expected = Configuration(
+            name='multiple_sections',
+            path='./data/multiple_sections.ini',
+            confd_path='./data/conf.d',
+            section_defaults={'sleep': '2', 'wait': '30'}
+        ).raw()
+
+        for executor in (None, 'thread', 'process'):
+            conf = Configuration(
+                name='multiple_sections',
+                path='./data/multiple_sections.ini',
+                confd_path='./data/conf.d',
+                section_defaults={'sleep': '2', 'wait': '30'},
+                workers=2,
+                executor=executor
+            )
+            self.assertEqual(expected, conf.raw())
+
+    def test_cache(self):
+        parser = counting_parser()
+        tmp, = self.make_tree(())
+        cache_dir = os.path.join(tmp, 'cache')
+
+        def build(**kwargs):
+            del parser.reads[:]
+            del parser.sources[:]
+            return Configuration(
+                name='multiple_sections',
+                path='./data/multiple_sections.ini',
+                confd_path='./data/conf.d',
+                config_parser=parser,
+                cache_dir=cache_dir,
+                **kwargs
+            )
+
+        # Misses are parsed from the bytes read to look them up
+        expected = build(section_defaults={'sleep': '2'}).raw()
+        self.assertEqual([os.path.realpath('./data/multiple_sections.ini')], parser.reads)
+        self.assertEqual(3, len(parser.sources))
+        self.assertEqual(3, len(os.listdir(cache_dir)))
+
+        conf = build(section_defaults={'sleep': '2'})
+        self.assertEqual(0, len(parser.sources))
+        self.assertEqual(expected, conf.raw())
+
+        conf = build(section_defaults={'sleep': '3'})
+        self.assertEqual(3, len(parser.sources))
+        self.assertEqual('3', conf.get('section', 'sleep'))
+        self.assertEqual('1', conf.get('another/conf', 'sleep'))
+
+        def all_as_int(config):
+            for key in config:
+                try:
+                    config[key] = int(config[key])
+                except ValueError:
+                    pass
+
+            return config
+
+        expected = {'sleep': 1, 'wait': 15}
+        conf = build(section_defaults={'sleep': '3'}, section_parser=all_as_int)
+        self.assertEqual(0, len(parser.sources))
+        self.assertEqual(expected, conf.get('another/conf'))
+
+        conf = build(section_defaults={'sleep': '3'}, section_parser=all_as_int, cache_parsed=True)
+        self.assertEqual(3, len(parser.sources))
+        conf = build(section_defaults={'sleep': '3'}, section_parser=all_as_int, cache_parsed=True)
+        self.assertEqual(0, len(parser.sources))
+        self.assertEqual(expected, conf.get('another/conf'))
+
+        def with_callback(config):
+            config['callback'] = lambda: None
+            return config
+
+        # Sections that can't be stored are not cached, the parse still works.
+        # Only empty.ini, which has no sections, comes from the cache next time
+        for misses in (3, 2):
+            conf = build(section_parser=with_callback, cache_parsed=True)
+            self.assertEqual(misses, len(parser.sources))
+            self.assertTrue(callable(conf.get('another/conf', 'callback')))
+
+        build(cache_size=2)
+        self.assertEqual(2, len(os.listdir(cache_dir)))
+
+        # Parsers with the same name in different classes get their own entries
+        class Ints(object):
+            @staticmethod
+            def parse(config):
+                return all_as_int(config)
+
+        class Callbacks(object):
+            @staticmethod
+            def parse(config):
+                return with_callback(config)
+
+        build(section_parser=Ints.parse, cache_parsed=True)
+        conf = build(section_parser=Callbacks.parse, cache_parsed=True)
+        self.assertTrue(callable(conf.get('another/conf', 'callback')))
+
+    def test_aparse(self):
+        import asyncio
+        from conf_d import aio
+
+        kwargs = dict(
+            name='multiple_sections',
+            path='./data/multiple_sections.ini',
+            confd_path='./data/conf.d',
+            main_defaults={'main_key': 'main_value'},
+            section_defaults={'sleep': '2', 'wait': '30'}
+        )
+        expected = Configuration(**kwargs).raw()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        conf = loop.run_until_complete(aio.load(batch_size=1, **kwargs))
+        self.assertEqual(expected, conf.raw())
+        self.assertEqual('brooklyn', conf.get('derp', 'til'))
+        self.assertTrue(conf.has('another/conf', 'sleep'))
+
+        conf = Configuration(parse=False, **kwargs)
+        loop.run_until_complete(conf.aparse())
+        self.assertEqual(expected, conf.raw())
+
+        # Parsing again starts from scratch like parse() does
+        conf = Configuration(parse=False, stats=True, dedupe=True, **kwargs)
+        for i in range(2):
+            loop.run_until_complete(conf.aparse())
+            self.assertEqual(5, conf.stats()['sections'])
+            self.assertEqual(expected, conf.raw())
+
+    def test_watcher(self):
+        from conf_d.watch import Watcher
+
+        for inotify in (False, None):
+            tmp, confd_path = self.make_tree()
+            write_file(os.path.join(tmp, 'conf'), '[main]\nkey: value\n')
+            write_file(os.path.join(confd_path, 'a.ini'), '[a]\nkey: value\n')
+            write_file(os.path.join(confd_path, 'b.ini'), '[b]\nkey: value\n')
+
+            conf = Configuration(name='main', path=os.path.join(tmp, 'conf'), confd_path=confd_path)
+            watcher = Watcher(conf, debounce=0.05, inotify=inotify)
+            self.addCleanup(watcher.stop)
+
+            events = []
+            watcher.subscribe(lambda *event: events.append(event))
+            self.assertEqual([], watcher.poll())
+
+            write_file(os.path.join(confd_path, 'a.ini'), '[a]\nkey: changed value\n')
+            write_file(os.path.join(confd_path, 'c.ini'), '[c]\nkey: value\n')
+            os.remove(os.path.join(confd_path, 'b.ini'))
+            watcher.poll(timeout=1)
+
+            expected = [
+                ('added', 'c', {'key': 'value'}),
+                ('changed', 'a', {'key': 'changed value'}),
+                ('removed', 'b', None),
+            ]
+            self.assertEqual(expected, events)
+
+            # A broken fragment is reported and the watcher keeps going
+            errors = []
+            watcher = Watcher(conf, interval=0.05, debounce=0.05, inotify=inotify, on_error=errors.append)
+            self.addCleanup(watcher.stop)
+            watcher.subscribe(lambda *event: events.append(event))
+            watcher.start()
+            del events[:]
+
+            write_file(os.path.join(confd_path, 'bad.ini'), 'key: value\n')
+            self.assertTrue(wait_for(lambda: errors))
+            self.assertTrue(isinstance(errors[0], MissingSectionHeaderError))
+            self.assertEqual({'key': 'changed value'}, conf.get('a'))
+
+            write_file(os.path.join(confd_path, 'bad.ini'), '[bad]\nkey: value\n')
+            write_file(os.path.join(confd_path, 'd.ini'), '[d]\nkey: value\n')
+            self.assertTrue(wait_for(lambda: len(events) == 2))
+            self.assertEqual([('added', 'bad', {'key': 'value'}), ('added', 'd', {'key': 'value'})], sorted(events))
+            self.assertTrue(watcher._thread.is_alive())
+
+    def test_lazy(self):
+        parser = counting_parser()
+        parsed = []
+
+        def track(config):
+            parsed.append(dict(config))
+            return config
+
+        kwargs = dict(
+            name='multiple_sections',
+            path='./data/multiple_sections.ini',
+            confd_path='./data/conf.d',
+            main_defaults={'main_key': 'main_value'},
+            section_defaults={'sleep': '2', 'wait': '30'},
+            section_parser=track,
+            config_parser=parser
+        )
+        expected = Configuration(**kwargs).raw()
+
+        del parsed[:]
+        del parser.reads[:]
+        conf = Configuration(lazy=True, **kwargs)
+        self.assertEqual(1, len(parser.reads))
+        self.assertEqual([], parsed)
+
+        self.assertTrue(conf.has('another/conf'))
+        self.assertFalse(conf.has('missing'))
+        self.assertEqual([], parsed)
+
+        self.assertEqual('1', conf.get('another/conf', 'sleep'))
+        self.assertEqual(2, len(parser.reads))
+        self.assertEqual([{'sleep': '1', 'wait': '15'}], parsed)
+
+        self.assertEqual({'sleep': '1', 'wait': '15'}, conf.get('another/conf'))
+        self.assertEqual({'key': 'value', 'sleep': '2', 'wait': '30'}, conf.raw('section'))
+        self.assertEqual(2, len(parser.reads))
+        self.assertEqual(2, len(parsed))
+
+        self.assertEqual(expected, conf.raw())
+        self.assertEqual(3, len(parser.reads))
+        self.assertEqual(4, len(parsed))
+
+        # Reloads only report the sections whose contents changed
+        tmp, confd = self.make_tree()
+        write_file(os.path.join(tmp, 'conf'), '[main]\n\n[m1]\nkey: value\n\n[m2]\nkey: value\n')
+        write_file(os.path.join(confd, 'a.ini'), '[a]\nkey: value\n\n[b]\nkey: value\n')
+        conf = Configuration(name='main', path=os.path.join(tmp, 'conf'), confd_path=confd, lazy=True)
+
+        write_file(os.path.join(confd, 'a.ini'), '# comment\n[a]\nkey: value\n\n[b]\nkey: other\n')
+        self.assertEqual({'added': [], 'changed': ['b'], 'removed': []}, conf.reload())
+        self.assertEqual('value', conf.get('a', 'key'))
+        write_file(os.path.join(confd, 'a.ini'), '[a]\nkey: value\n\n[b]\nkey: value\n')
+        self.assertEqual({'added': [], 'changed': ['b'], 'removed': []}, conf.reload())
+        write_file(os.path.join(confd, 'a.ini'), '[DEFAULT]\nwait: 1\n\n[a]\nkey: value\n\n[b]\nkey: value\n')
+        self.assertEqual({'added': [], 'changed': ['a', 'b'], 'removed': []}, conf.reload())
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\nworkers: 2\n\n[m1]\nkey: value\n\n[m2]\nkey: other\n')
+        self.assertEqual({'added': [], 'changed': ['m2', 'main'], 'removed': []}, conf.reload())
+
+    def test_fast_config_parser(self):
+        from conf_d.reader import FastConfigParser
+
+        for path in ('conf', 'default_section.ini', 'empty.ini', 'multiple_sections.ini', 'single_section.ini'):
+            kwargs = dict(
+                name='derp',
+                path=os.path.join('./data', path),
+                confd_path='./data/conf.d',
+                main_defaults={'no': 'one', 'cats': 1},
+                section_defaults={'sleep': '2', 'wait': '30'}
+            )
+            expected = Configuration(**kwargs).raw()
+            actual = Configuration(config_parser=FastConfigParser, **kwargs).raw()
+            self.assertEqual(expected, actual)
+
+        # Interpolated defaults set after the read, on the main file and on
+        # layered conf.d files
+        kwargs = dict(
+            name='multiple_sections',
+            path='./data/multiple_sections.ini',
+            confd_path=['./data/conf.d'],
+            section_defaults={'label': '%(sleep)s-log', 'sleep': 'x'}
+        )
+        expected = Configuration(**kwargs).raw()
+        self.assertEqual('15-log', expected['sections']['test']['label'])
+        self.assertEqual('x-log', expected['sections']['derp']['label'])
+        self.assertEqual(expected, Configuration(config_parser=FastConfigParser, **kwargs).raw())
+
+        config_parser = FastConfigParser({'key_two': 'other_value'})
+        self.assertEqual(['./data/multiple_sections.ini'], config_parser.read('./data/multiple_sections.ini'))
+        self.assertEqual(None, config_parser._fallback)
+        self.assertEqual(['multiple_sections', 'section', 'derp'], config_parser.sections())
+        self.assertEqual({'key': 'value', 'key_two': 'other_value'}, dict(config_parser.items('section')))
+
+        config_parser = FastConfigParser()
+        self.assertEqual(['./data/default_section.ini'], config_parser.read('./data/default_section.ini'))
+        self.assertNotEqual(None, config_parser._fallback)
+        self.assertEqual({'key': 'from_file', 'shared': 'from_file'}, dict(config_parser.items('default_section')))
+
+        self.assertEqual([], FastConfigParser().read('/non-existent/path'))
+
+    def test_share_defaults(self):
+        def all_as_int(config):
+            for key in config:
+                try:
+                    config[key] = int(config[key])
+                except ValueError:
+                    pass
+
+            return config
+
+        for section_parser in (None, all_as_int):
+            kwargs = dict(
+                name='multiple_sections',
+                path='./data/multiple_sections.ini',
+                confd_path='./data/conf.d',
+                section_defaults={'sleep': '2', 'wait': '30'},
+                section_parser=section_parser
+            )
+            expected = Configuration(**kwargs).raw()
+            conf = Configuration(share_defaults=True, **kwargs)
+
+            self.assertEqual(expected, conf.raw())
+            self.assertEqual(expected['sections']['derp'], conf.get('derp'))
+            self.assertEqual(expected['sections']['derp']['wait'], conf.get('derp', 'wait'))
+            self.assertEqual('sleep', conf.get('derp', 'no'))
+            self.assertEqual(None, conf.get('derp', 'missing_key'))
+            self.assertTrue(conf.has('derp', 'wait'))
+            self.assertFalse(conf.has('derp', 'missing_key'))
+
+            raw = conf.raw(materialize=True)
+            self.assertEqual(expected, raw)
+            self.assertEqual(dict, type(raw['sections']['derp']))
+            self.assertEqual(dict, type(conf.raw('derp', materialize=True)))
+
+        conf = Configuration(share_defaults=True, **dict(kwargs, section_parser=None))
+        self.assertEqual({'no': 'sleep', 'til': 'brooklyn'}, conf.get('derp')._own)
+        self.assertTrue(conf.get('derp')._shared is conf.get('section')._shared)
+        self.assertEqual({'sleep': '1', 'wait': '15'}, conf.get('another/conf')._own)
+
+    def test_stats(self):
+        self.assertEqual(None, Configuration(name='derp', path='./data/conf').stats())
+
+        reported = []
+        conf = Configuration(
+            name='multiple_sections',
+            path='./data/multiple_sections.ini',
+            confd_path='./data/conf.d',
+            section_parser=lambda config: config,
+            stats=lambda path, timings: reported.append(path)
+        )
+
+        stats = conf.stats(n=2)
+        self.assertEqual(4, stats['files'])
+        self.assertEqual(5, stats['sections'])
+        self.assertEqual(7, stats['keys'])
+        self.assertEqual(set(['listdir', 'scan', 'realpath', 'read', 'items', 'section_parser']), set(stats['seconds']))
+        self.assertEqual(2, len(stats['slowest']))
+        self.assertTrue(stats['slowest'][0]['total'] >= stats['slowest'][1]['total'])
+        self.assertEqual(4, len(reported))
+        self.assertEqual(os.path.realpath('./data/multiple_sections.ini'), reported[0])
+
+        another_conf = [s for s in conf._stats.slowest(n=4) if s['path'].endswith('another_conf.ini')][0]
+        self.assertEqual(1, another_conf['sections'])
+        self.assertEqual(2, another_conf['keys'])
+
+        tmp, confd = self.make_tree()
+        write_file(os.path.join(tmp, 'conf'), '[main]\n\n[m1]\nkey: value\n')
+        write_file(os.path.join(confd, 'a.ini'), '[a]\nkey: value\n')
+        write_file(os.path.join(confd, 'b.ini'), '[b]\nkey: value\n')
+
+        # Reloads replace the numbers of the files they parse again
+        conf = Configuration(name='main', path=os.path.join(tmp, 'conf'), confd_path=confd, stats=True)
+        self.assertEqual((4, 3), (conf.stats()['sections'], conf.stats()['keys']))
+        write_file(os.path.join(confd, 'a.ini'), '[a]\nkey: value\nsleep: 1\n')
+        conf.reload()
+        self.assertEqual((4, 4), (conf.stats()['sections'], conf.stats()['keys']))
+        os.remove(os.path.join(confd, 'b.ini'))
+        conf.reload()
+        self.assertEqual((2, 3, 3), (conf.stats()['files'], conf.stats()['sections'], conf.stats()['keys']))
+
+    def test_snapshot(self):
+        tmp, confd_path = self.make_tree()
+        write_file(os.path.join(tmp, 'conf'), '[main]\nkey: value\n\n[section]\nkey: value\n')
+        write_file(os.path.join(confd_path, 'a.ini'), '[a]\nkey: value\n')
+        write_file(os.path.join(confd_path, 'b.ini'), '[b]\nkey: value\n')
+        snapshot_path = os.path.join(tmp, 'snapshot')
+
+        conf = Configuration(name='main', path=os.path.join(tmp, 'conf'), confd_path=confd_path, section_defaults={'wait': 30})
+        conf.dump_snapshot(snapshot_path)
+
+        loaded = Configuration.load_snapshot(snapshot_path)
+        self.assertEqual(conf.raw(), loaded.raw())
+        self.assertEqual('value', loaded.get('a', 'key'))
+        self.assertEqual({'added': [], 'changed': [], 'removed': []}, loaded.reload())
+
+        write_file(os.path.join(confd_path, 'c.ini'), '[c]\nkey: value\n')
+        self.assertRaises(IOError, lambda: Configuration.load_snapshot(snapshot_path))
+
+        loaded = Configuration.load_snapshot(snapshot_path, verify=False)
+        self.assertFalse(loaded.has('c'))
+        self.assertEqual({'added': ['c'], 'changed': [], 'removed': []}, loaded.reload())
+
+        # Lazy sections shadowed by another file are built before dumping
+        write_file(os.path.join(confd_path, 'c.ini'), '[section]\nkey: from c\n\n[a]\nkey: from c\n')
+        conf = Configuration(name='main', path=os.path.join(tmp, 'conf'), confd_path=confd_path, lazy=True)
+        conf.dump_snapshot(snapshot_path)
+        loaded = Configuration.load_snapshot(snapshot_path)
+        self.assertEqual(conf.raw(), loaded.raw())
+        self.assertEqual('from c', loaded.get('a', 'key'))
+
+        write_file(snapshot_path, 'garbage')
+        self.assertRaises(IOError, lambda: Configuration.load_snapshot(snapshot_path))
+        write_file(snapshot_path, '')
+        self.assertRaises(IOError, lambda: Configuration.load_snapshot(snapshot_path))
+
+    def test_iter_sections(self):
+        conf = Configuration(
+            name='multiple_sections',
+            path='./data/multiple_sections.ini',
+            confd_path='./data/conf.d',
+            main_defaults={'main_key': 'main_value'},
+            section_defaults={'wait': '30'},
+            parse=False
+        )
+
+        main_path = os.path.realpath('./data/multiple_sections.ini')
+        expected = [
+            (main_path, 'multiple_sections', {'main_key': 'main_value'}),
+            (main_path, 'section', {'key': 'value', 'wait': '30'}),
+            (main_path, 'derp', {'no': 'sleep', 'til': 'brooklyn', 'wait': '30'}),
+            (os.path.realpath('./data/conf.d/another_conf.ini'), 'another/conf', {'sleep': '1', 'wait': '15'}),
+            (os.path.realpath('./data/conf.d/test.ini'), 'test', {'conf': 'path/to/another/conf', 'sleep': '15', 'wait': '30'}),
+        ]
+        self.assertEqual(expected, list(conf.iter_sections()))
+        self.assertEqual({}, conf.raw()['sections'])
+
+        # Files are parsed one at a time and the instance keeps no stats
+        conf = Configuration(
+            name='multiple_sections',
+            path='./data/multiple_sections.ini',
+            confd_path='./data/conf.d',
+            main_defaults={'main_key': 'main_value'},
+            section_defaults={'wait': '30'},
+            workers=2,
+            executor='process',
+            stats=True,
+            dedupe=True,
+            parse=False
+        )
+        self.assertEqual(expected, list(conf.iter_sections()))
+        self.assertEqual(0, conf.stats()['files'])
+        self.assertEqual({}, conf._bodies)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_shared(self):
+        from conf_d.shared import SharedConfiguration
+
+        tmp, confd_path = self.make_tree()
+        write_file(os.path.join(tmp, 'conf'), '[main]\nkey: value\n')
+        write_file(os.path.join(confd_path, 'a.ini'), '[a]\nkey: value\n')
+
+        conf = Configuration(name='main', path=os.path.join(tmp, 'conf'), confd_path=confd_path)
+        shared = SharedConfiguration(conf, path=os.path.join(tmp, 'snapshot'))
+        self.addCleanup(shared.close)
+        self.assertEqual(1, shared.version)
+
+        requests_read, requests_write = os.pipe()
+        results_read, results_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(requests_write)
+                os.close(results_read)
+                while os.read(requests_read, 1):
+                    result = '%d %s %s' % (shared.version, shared.get('a', 'key'), shared.has('b'))
+                    os.write(results_write, result.encode('utf-8').ljust(64))
+            finally:
+                os._exit(0)
+
+        os.close(requests_read)
+        os.close(results_write)
+
+        def ask():
+            os.write(requests_write, b'?')
+            return os.read(results_read, 64).decode('utf-8').strip()
+
+        self.assertEqual('1 value False', ask())
+
+        write_file(os.path.join(confd_path, 'a.ini'), '[a]\nkey: changed value\n')
+        write_file(os.path.join(confd_path, 'b.ini'), '[b]\nkey: value\n')
+        shared.reload()
+        self.assertEqual(2, shared.version)
+        self.assertEqual('2 changed value True', ask())
+
+        self.assertEqual({'added': [], 'changed': [], 'removed': []}, shared.reload())
+        self.assertEqual(2, shared.version)
+
+        os.close(requests_write)
+        os.waitpid(pid, 0)
+        os.close(results_read)
+
+    def test_recursive(self):
+        tmp, confd_path = self.make_tree()
+        os.makedirs(os.path.join(confd_path, 'b', 'nested'))
+        os.makedirs(os.path.join(confd_path, 'archive'))
+        write_file(os.path.join(tmp, 'conf'), '[main]\n')
+        write_file(os.path.join(confd_path, 'a.ini'), '[a]\nkey: a\n')
+        write_file(os.path.join(confd_path, 'b', 'b.conf'), '[b]\nkey: b\n')
+        write_file(os.path.join(confd_path, 'b', 'nested', 'a.ini'), '[a]\nkey: nested\n')
+        write_file(os.path.join(confd_path, 'b', 'ignored.txt'), '[ignored]\nkey: value\n')
+        write_file(os.path.join(confd_path, 'archive', 'old.ini'), '[old]\nkey: value\n')
+        os.symlink(confd_path, os.path.join(confd_path, 'b', 'loop'))
+
+        kwargs = dict(name='main', path=os.path.join(tmp, 'conf'), confd_path=confd_path)
+
+        conf = Configuration(**kwargs)
+        self.assertEqual({'a': {'key': 'a'}}, conf.raw()['sections'])
+
+        conf = Configuration(recursive=True, **kwargs)
+        self.assertEqual(['a', 'b', 'ignored', 'old'], sorted(conf.raw()['sections']))
+        self.assertEqual('nested', conf.get('a', 'key'))
+
+        conf = Configuration(recursive=True, include=['*.ini', '*.conf'], exclude='archive/*', **kwargs)
+        self.assertEqual(['a', 'b'], sorted(conf.raw()['sections']))
+        self.assertEqual('nested', conf.get('a', 'key'))
+
+        conf = Configuration(recursive=True, include='*.ini', exclude='b/nested', **kwargs)
+        self.assertEqual({'a': {'key': 'a'}, 'old': {'key': 'value'}}, conf.raw()['sections'])
+
+        from conf_d import snapshot
+        nested = os.path.join(confd_path, 'b', 'nested')
+        os.utime(nested, (0, 0))
+        path = os.path.join(tmp, 'snapshot')
+        Configuration(recursive=True, **kwargs).dump_snapshot(path)
+        self.assertTrue(snapshot.is_fresh(snapshot.read(path)))
+
+        write_file(os.path.join(nested, 'c.ini'), '[c]\nkey: c\n')
+        self.assertFalse(snapshot.is_fresh(snapshot.read(path)))
+
+    def test_layers(self):
+        tmp, vendor, site, host = self.make_tree(('vendor', 'site', 'host'))
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\n\n[syslog]\ntype: main\n')
+        write_file(os.path.join(vendor, 'syslog.ini'), '[syslog]\ntype: syslog\npath: /var/log/syslog\nsleep: 5\n')
+        write_file(os.path.join(vendor, 'nginx.ini'), '[nginx]\ntype: nginx\n')
+        write_file(os.path.join(site, 'a.ini'), '[syslog]\ntags: site\n')
+        write_file(os.path.join(site, 'b.ini'), '[syslog]\npath: /srv/log/syslog\n')
+        write_file(os.path.join(host, 'syslog.ini'), '[syslog]\nsleep: 2\n\n[host]\ntype: host\n')
+
+        conf = Configuration(
+            name='main',
+            path=os.path.join(tmp, 'conf'),
+            confd_path=[vendor, site, host],
+            section_defaults={'sleep': '2', 'tags': ''}
+        )
+
+        expected = {'type': 'syslog', 'path': '/srv/log/syslog', 'sleep': '2', 'tags': ''}
+        self.assertEqual(expected, conf.get('syslog'))
+        self.assertEqual({'type': 'nginx', 'sleep': '2', 'tags': ''}, conf.get('nginx'))
+        self.assertEqual({'type': 'host', 'sleep': '2', 'tags': ''}, conf.get('host'))
+
+        self.assertEqual(os.path.join(host, 'syslog.ini'), conf.source('syslog'))
+        self.assertEqual(os.path.join(vendor, 'syslog.ini'), conf.source('syslog', 'type'))
+        self.assertEqual(os.path.join(site, 'b.ini'), conf.source('syslog', 'path'))
+        self.assertEqual(os.path.join(host, 'syslog.ini'), conf.source('syslog', 'sleep'))
+        self.assertEqual(os.path.join(vendor, 'nginx.ini'), conf.source('nginx', 'type'))
+        self.assertEqual(os.path.join(tmp, 'conf'), conf.source('main'))
+        self.assertRaises(KeyError, lambda: conf.source('missing'))
+
+        write_file(os.path.join(host, 'syslog.ini'), '[host]\ntype: host\n')
+        self.assertEqual({'added': [], 'changed': ['syslog'], 'removed': []}, conf.reload())
+        self.assertEqual('5', conf.get('syslog', 'sleep'))
+
+        main_path = os.path.realpath(os.path.join(tmp, 'conf'))
+        self.assertEqual([
+            (main_path, 'main'),
+            (main_path, 'syslog'),
+            (os.path.join(vendor, 'nginx.ini'), 'nginx'),
+            (os.path.join(vendor, 'syslog.ini'), 'syslog'),
+            (os.path.join(site, 'a.ini'), 'syslog'),
+            (os.path.join(site, 'b.ini'), 'syslog'),
+            (os.path.join(host, 'syslog.ini'), 'host'),
+        ], [(path, section) for path, section, config in conf.iter_sections()])
+
+        self.assertRaises(ValueError, lambda: Configuration(name='main', path=os.path.join(tmp, 'conf'), confd_path=[vendor], lazy=True))
+
+    def test_index(self):
+        tmp, confd = self.make_tree()
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\n')
+        write_file(os.path.join(confd, 'syslog.ini'), '[syslog]\ntype: syslog\npath: /var/log/syslog\n')
+        write_file(os.path.join(confd, 'auth.ini'), '[auth]\ntype: syslog\npath: /var/log/auth.log\n')
+        write_file(os.path.join(confd, 'nginx.ini'), '[nginx]\ntype: nginx\npath: /srv/log/nginx.log\n')
+
+        for lazy in (False, True):
+            conf = Configuration(
+                name='main',
+                path=os.path.join(tmp, 'conf'),
+                confd_path=confd,
+                index=['type'],
+                lazy=lazy
+            )
+
+            self.assertEqual(['auth', 'syslog'], sorted(conf.find(type='syslog')))
+            self.assertEqual(['auth'], sorted(conf.find(type='syslog', path='/var/log/auth.log')))
+            self.assertEqual(['nginx'], sorted(conf.find(path='/srv/log/nginx.log')))
+            self.assertEqual({}, conf.find(type='missing'))
+            self.assertEqual(conf.get('nginx'), conf.find(type='nginx')['nginx'])
+
+            self.assertEqual(['nginx'], sorted(conf.select(lambda value: value != 'syslog', key='type')))
+            self.assertEqual(['auth', 'syslog'], sorted(conf.select(lambda value: value.startswith('/var/log/'), key='path')))
+            self.assertEqual(['nginx'], sorted(conf.select(lambda section, config: section.startswith('n'))))
+
+        write_file(os.path.join(confd, 'auth.ini'), '[auth]\ntype: auth\n')
+        os.remove(os.path.join(confd, 'nginx.ini'))
+        write_file(os.path.join(confd, 'kern.ini'), '[kern]\ntype: syslog\n')
+        conf.reload()
+
+        self.assertEqual(['kern', 'syslog'], sorted(conf.find(type='syslog')))
+        self.assertEqual(['auth'], sorted(conf.find(type='auth')))
+        self.assertEqual({}, conf.find(type='nginx'))
+
+    def test_schema(self):
+        from conf_d.schema import Field, Schema, SchemaError
+
+        tmp, confd = self.make_tree()
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\nworkers: 4\n\n[main_section]\nsleep: 1\n')
+        write_file(os.path.join(confd, 'a.ini'), '[a]\nsleep: 5\nwait: 0.5\nenabled: yes\n')
+        write_file(os.path.join(confd, 'b.ini'), '[b]\npath: /var/log/b\n')
+
+        section_schema = {
+            'sleep': Field(int, default=2, validator=lambda value: value > 0),
+            'wait': float,
+            'enabled': Field(bool, default=False),
+        }
+        kwargs = dict(
+            name='main',
+            path=os.path.join(tmp, 'conf'),
+            confd_path=confd,
+            main_schema={'workers': Field(int, required=True)},
+            section_schema=section_schema
+        )
+
+        for lazy in (False, True):
+            conf = Configuration(lazy=lazy, **kwargs)
+            self.assertEqual({'workers': 4}, conf.get('main'))
+            self.assertEqual({'sleep': 1, 'enabled': False}, conf.get('main_section'))
+            self.assertEqual({'sleep': 5, 'wait': 0.5, 'enabled': True}, conf.get('a'))
+            self.assertEqual({'path': '/var/log/b', 'sleep': 2, 'enabled': False}, conf.get('b'))
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\n\n[main_section]\nsleep: 1\n')
+        write_file(os.path.join(confd, 'a.ini'), '[a]\nsleep: -1\nwait: never\nenabled: maybe\n')
+        write_file(os.path.join(confd, 'b.ini'), '[b]\nsleep: soon\n')
+
+        try:
+            Configuration(**kwargs)
+        except SchemaError as e:
+            errors = sorted(e.errors)
+        else:
+            self.fail('SchemaError not raised')
+
+        main_path = os.path.realpath(os.path.join(tmp, 'conf'))
+        a_path, b_path = os.path.join(confd, 'a.ini'), os.path.join(confd, 'b.ini')
+        self.assertEqual(sorted([
+            (a_path, 'a', 'enabled', "invalid bool value 'maybe'"),
+            (a_path, 'a', 'sleep', 'failed validation with value -1'),
+            (a_path, 'a', 'wait', "invalid float value 'never'"),
+            (b_path, 'b', 'sleep', "invalid int value 'soon'"),
+            (main_path, 'main', 'workers', 'missing required key'),
+        ]), errors)
+
+        schema = Schema(section_schema)
+        self.assertEqual({'sleep': 3, 'enabled': True}, schema({'sleep': '3', 'enabled': 'on'}))
+        self.assertRaises(SchemaError, lambda: schema({'sleep': '0'}))
+
+    def test_failed_reload(self):
+        from conf_d.schema import SchemaError
+
+        tmp, confd = self.make_tree()
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\n\n[m1]\nsleep: 1\n')
+        write_file(os.path.join(confd, 'a.ini'), '[a]\nsleep: 5\n')
+
+        conf = Configuration(name='main', path=os.path.join(tmp, 'conf'), confd_path=confd, section_schema={'sleep': int})
+        self.assertEqual({'sleep': 1}, conf.get('m1'))
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\n\n[m1]\nsleep: bad\n')
+        self.assertRaises(SchemaError, conf.reload)
+        self.assertEqual(1, conf.generation)
+        self.assertEqual({'sleep': 1}, conf.get('m1'))
+
+        write_file(os.path.join(confd, 'a.ini'), '[a]\nsleep: 10\n')
+        self.assertEqual({'added': [], 'changed': ['a'], 'removed': []}, conf.reload(paths=[os.path.join(confd, 'a.ini')]))
+        self.assertEqual({'sleep': 1}, conf.get('m1'))
+        self.assertEqual({'sleep': 10}, conf.get('a'))
+
+        self.assertRaises(SchemaError, conf.reload)
+
+    def test_bulk_lookups(self):
+        for share_defaults in (False, True):
+            conf = Configuration(
+                name='multiple_sections',
+                path='./data/multiple_sections.ini',
+                section_defaults={'sleep': '2'},
+                share_defaults=share_defaults
+            )
+
+            self.assertEqual(['sleep', '2', None], conf.get_many('derp', ['no', 'sleep', 'missing']))
+            self.assertEqual(['x', 'x'], conf.get_many('derp', ['missing', 'missing'], default='x'))
+            self.assertRaises(KeyError, lambda: conf.get_many('missing', ['no']))
+
+            view = conf.view('derp')
+            self.assertEqual(dict(conf.get('derp')), dict(view))
+            self.assertEqual('2', view['sleep'])
+            try:
+                view['sleep'] = '3'
+            except TypeError:
+                pass
+            else:
+                self.fail('view is writable')
+            self.assertEqual(conf.get('multiple_sections'), dict(conf.view('multiple_sections')))
+
+    def test_generations(self):
+        tmp, confd = self.make_tree()
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\nworkers: 1\n')
+        write_file(os.path.join(confd, 'a.ini'), '[a]\nsleep: 1\n')
+
+        conf = Configuration(name='main', path=os.path.join(tmp, 'conf'), confd_path=confd)
+        self.assertEqual(1, conf.generation)
+
+        pinned = conf.pin()
+        write_file(os.path.join(tmp, 'conf'), '[main]\nworkers: 2\n')
+        write_file(os.path.join(confd, 'a.ini'), '[a]\nsleep: 2\n')
+        write_file(os.path.join(confd, 'b.ini'), '[b]\nsleep: 3\n')
+        self.assertEqual({'added': ['b'], 'changed': ['a', 'main'], 'removed': []}, conf.reload())
+
+        self.assertEqual(2, conf.generation)
+        self.assertEqual('2', conf.get('a', 'sleep'))
+        self.assertEqual('2', conf.get('main', 'workers'))
+        self.assertEqual(1, pinned.generation)
+        self.assertEqual('1', pinned.get('a', 'sleep'))
+        self.assertEqual('1', pinned.get('main', 'workers'))
+        self.assertFalse(pinned.has('b'))
+
+        # A failed reload keeps the last published generation
+        write_file(os.path.join(tmp, 'conf'), '[main]\nworkers: 3\n')
+        write_file(os.path.join(confd, 'b.ini'), 'not an ini file\n')
+        self.assertRaises(MissingSectionHeaderError, conf.reload)
+        self.assertEqual(2, conf.generation)
+        self.assertEqual('2', conf.get('main', 'workers'))
+        self.assertEqual('3', conf.get('b', 'sleep'))
+
+        write_file(os.path.join(confd, 'b.ini'), '[b]\nsleep: 4\n')
+        self.assertEqual({'added': [], 'changed': ['b', 'main'], 'removed': []}, conf.reload())
+        self.assertEqual('3', conf.get('main', 'workers'))
+        self.assertEqual(3, conf.generation)
+
+    def test_dedupe(self):
+        parser = counting_parser()
+        tmp, confd = self.make_tree()
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\n\n[main_section]\ntype: file\nsleep: 1\n')
+        for name in ('a', 'b', 'c'):
+            write_file(os.path.join(confd, '%s.ini' % name), '[shared]\ntype: file\nsleep: 1\n')
+        write_file(os.path.join(confd, 'd.ini'), '[other]\ntype: file\nsleep: 1\n\n[different]\ntype: file\n')
+
+        conf = Configuration(
+            name='main',
+            path=os.path.join(tmp, 'conf'),
+            confd_path=confd,
+            config_parser=parser,
+            dedupe=True
+        )
+
+        # conf.d files are parsed from the bytes already read to hash them
+        self.assertEqual([os.path.realpath(os.path.join(tmp, 'conf'))], parser.reads)
+        self.assertEqual([os.path.join(confd, 'a.ini'), os.path.join(confd, 'd.ini')], parser.sources)
+        self.assertEqual(os.path.join(confd, 'c.ini'), conf.source('shared'))
+        self.assertEqual({'type': 'file', 'sleep': '1'}, conf.get('shared'))
+        self.assertTrue(conf.get('shared') is conf.get('other'))
+        self.assertTrue(conf.get('shared') is conf.get('main_section'))
+        self.assertEqual({'type': 'file'}, conf.get('different'))
+
+        try:
+            conf.get('shared')['sleep'] = '2'
+        except TypeError:
+            pass
+        else:
+            self.fail('deduplicated section is writable')
+
+        write_file(os.path.join(confd, 'b.ini'), '[shared]\ntype: file\nsleep: 2\n')
+        self.assertEqual({'added': [], 'changed': [], 'removed': []}, conf.reload())
+        write_file(os.path.join(confd, 'c.ini'), '[shared]\ntype: file\nsleep: 2\n')
+        self.assertEqual({'added': [], 'changed': ['shared'], 'removed': []}, conf.reload())
+        self.assertEqual('2', conf.get('shared', 'sleep'))
+        self.assertEqual('1', conf.get('other', 'sleep'))
+
+        # Bodies no file holds any more are dropped on reload
+        for sleep in range(3, 13):
+            write_file(os.path.join(confd, 'd.ini'), '[other]\ntype: file\nsleep: %d\n\n[different]\ntype: file\n' % sleep)
+            conf.reload()
+        self.assertEqual(4, len(conf._bodies))
+
+    def test_origin(self):
+        parser = counting_parser()
+        tmp, confd = self.make_tree()
+
+        main_path = os.path.join(tmp, 'conf')
+        a_path, b_path = os.path.join(confd, 'a.ini'), os.path.join(confd, 'b.ini')
+        write_file(main_path, '[main]\nworkers: 4\n\n[syslog]\ntype: syslog\npath: /var/log/syslog\n')
+        write_file(a_path, '[DEFAULT]\ntags: default\n\n[syslog]\n# comment\ntype: syslog\nPath = /var/log/messages\n')
+        write_file(b_path, '[nginx]\ntype: nginx\n')
+
+        conf = Configuration(
+            name='main',
+            path=main_path,
+            confd_path=confd,
+            section_defaults={'sleep': '1'},
+            provenance=True
+        )
+
+        self.assertEqual({'path': main_path, 'line': 2, 'layer': None, 'overrides': []}, conf.origin('main', 'workers'))
+        self.assertEqual({
+            'path': a_path,
+            'line': 7,
+            'layer': None,
+            'overrides': [{'path': main_path, 'line': 6, 'layer': None}],
+        }, conf.origin('syslog', 'path'))
+        self.assertEqual(4, conf.origin('syslog')['line'])
+        self.assertEqual({'path': a_path, 'line': 2, 'layer': None, 'overrides': []}, conf.origin('syslog', 'tags'))
+        self.assertEqual({'path': None, 'line': None, 'layer': None, 'overrides': []}, conf.origin('nginx', 'sleep'))
+        self.assertEqual(None, conf.origin('nginx', 'missing'))
+        self.assertRaises(KeyError, lambda: conf.origin('missing'))
+
+        snapshot = os.path.join(tmp, 'snapshot')
+        conf.dump_snapshot(snapshot)
+        loaded = Configuration.load_snapshot(snapshot, provenance=True)
+        self.assertEqual(conf.origin('syslog', 'path'), loaded.origin('syslog', 'path'))
+
+        site = os.path.join(tmp, 'site')
+        os.mkdir(site)
+        write_file(os.path.join(site, 'syslog.ini'), '[syslog]\n\npath: /srv/log/syslog\n')
+        conf = Configuration(name='main', path=main_path, confd_path=[confd, site], provenance=True, config_parser=parser)
+        # Lines are found in the contents handed to the parser, not by reading again
+        self.assertEqual([], parser.reads)
+        self.assertEqual({
+            'path': os.path.join(site, 'syslog.ini'),
+            'line': 3,
+            'layer': 1,
+            'overrides': [{'path': main_path, 'line': 6, 'layer': None}, {'path': a_path, 'line': 7, 'layer': 0}],
+        }, conf.origin('syslog', 'path'))
+        self.assertEqual(a_path, conf.origin('syslog', 'type')['path'])
+
+        # A pinned copy keeps the lines of the generation it reads
+        pinned = conf.pin()
+        expected = pinned.origin('syslog', 'path')
+        write_file(os.path.join(site, 'syslog.ini'), '[syslog]\n\n\n\npath: /srv/log/syslog\n')
+        conf.reload()
+        self.assertEqual(5, conf.origin('syslog', 'path')['line'])
+        self.assertEqual(expected, pinned.origin('syslog', 'path'))
+
+        self.assertRaises(ValueError, lambda: Configuration(name='main', path=main_path).origin('main'))
+
+    def test_tolerant(self):
+        from conf_d import ParseError
+
+        tmp, confd = self.make_tree()
+
+        a_path, b_path, c_path = [os.path.join(confd, '%s.ini' % name) for name in ('a', 'b', 'c')]
+        write_file(os.path.join(tmp, 'conf'), '[main]\n')
+        write_file(a_path, '[a]\nsleep: 1\n')
+        write_file(b_path, 'no section header\n')
+        write_file(c_path, '[c]\nsleep: 3\n')
+
+        kwargs = dict(name='main', path=os.path.join(tmp, 'conf'), confd_path=confd)
+        self.assertRaises(MissingSectionHeaderError, lambda: Configuration(**kwargs))
+        self.assertRaises(ParseError, lambda: Configuration(tolerant=True, max_errors=0, **kwargs))
+        self.assertRaises(ParseError, lambda: Configuration(tolerant=True, max_errors=0.2, **kwargs))
+
+        for options in ({}, {'executor': 'thread', 'workers': 2}, {'stats': True}):
+            conf = Configuration(tolerant=True, max_errors=2, **dict(kwargs, **options))
+            self.assertEqual({'main': {}, 'sections': {'a': {'sleep': '1'}, 'c': {'sleep': '3'}}}, conf.raw())
+            self.assertEqual([b_path], list(conf.failures()))
+
+        # Streaming reports failures to the caller instead of skipping files
+        self.assertRaises(ParseError, lambda: list(conf.iter_sections()))
+        failures = {}
+        self.assertEqual(['a', 'c'], [section for path, section, config in conf.iter_sections(failures=failures) if path != conf.source('main')])
+        self.assertEqual([b_path], list(failures))
+        self.assertRaises(ParseError, lambda: list(Configuration(tolerant=True, max_errors=0, parse=False, **kwargs).iter_sections(failures={})))
+
+        # A file that breaks keeps its last good sections
+        write_file(a_path, '[a\nsleep: 2\n')
+        self.assertEqual({'added': [], 'changed': [], 'removed': []}, conf.reload())
+        self.assertEqual('1', conf.get('a', 'sleep'))
+        self.assertEqual([a_path, b_path], sorted(conf.failures()))
+
+        write_file(c_path, '[c\n')
+        self.assertRaises(ParseError, conf.reload)
+        self.assertEqual('3', conf.get('c', 'sleep'))
+
+        write_file(a_path, '[a]\nsleep: 4\n')
+        write_file(c_path, '[c]\nsleep: 5\n')
+        os.remove(b_path)
+        self.assertEqual({'added': [], 'changed': ['a', 'c'], 'removed': []}, conf.reload())
+        self.assertEqual({}, conf.failures())
+
+    def test_overrides(self):
+        from conf_d import overrides
+
+        tmp, vendor, site = self.make_tree(('vendor', 'site'))
+
+        write_file(os.path.join(tmp, 'conf'), '[main]\nworkers: 1\n\n[main_section]\nsleep: 1\n')
+        write_file(os.path.join(vendor, 'syslog.ini'), '[syslog]\nsleep: 2\npath: /var/log/syslog\n')
+        write_file(os.path.join(site, 'syslog.ini'), '[syslog]\nsleep: 3\n')
+
+        os.environ['CONF_D_TEST__SYSLOG__SLEEP'] = '4'
+        os.environ['CONF_D_TEST__MAIN__WORKERS'] = '8'
+        os.environ['CONF_D_TEST__MISSING__KEY'] = 'value'
+        self.addCleanup(os.environ.pop, 'CONF_D_TEST__SYSLOG__SLEEP')
+        self.addCleanup(os.environ.pop, 'CONF_D_TEST__MAIN__WORKERS')
+        self.addCleanup(os.environ.pop, 'CONF_D_TEST__MISSING__KEY')
+
+        seen = []
+
+        def track(config):
+            seen.append(dict(config))
+            return config
+
+        for confd_path in (vendor, [vendor, site]):
+            del seen[:]
+            conf = Configuration(
+                name='main',
+                path=os.path.join(tmp, 'conf'),
+                confd_path=confd_path,
+                section_parser=track,
+                env_prefix='CONF_D_TEST',
+                overrides=overrides.from_args(['main_section.sleep=5', 'syslog.path=/tmp/syslog'])
+            )
+
+            self.assertEqual({'workers': '8'}, conf.get('main'))
+            self.assertEqual({'sleep': '5'}, conf.get('main_section'))
+            self.assertEqual({'sleep': '4', 'path': '/tmp/syslog'}, conf.get('syslog'))
+            self.assertFalse(conf.has('missing'))
+            self.assertTrue({'sleep': '4', 'path': '/tmp/syslog'} in seen)
+
+        # Sections match regardless of case, keys go through optionxform
+        write_file(os.path.join(vendor, 'nginx.ini'), '[Nginx]\nsleep: 2\n')
+        os.environ['CONF_D_TEST__NGINX__SLEEP'] = '6'
+        self.addCleanup(os.environ.pop, 'CONF_D_TEST__NGINX__SLEEP')
+        for confd_path in (vendor, [vendor, site]):
+            conf = Configuration(
+                name='main',
+                path=os.path.join(tmp, 'conf'),
+                confd_path=confd_path,
+                env_prefix='CONF_D_TEST',
+                overrides=overrides.from_args(['Nginx.Path=/tmp/nginx', 'Syslog.Path=/tmp/syslog'])
+            )
+            self.assertEqual({'sleep': '6', 'path': '/tmp/nginx'}, conf.get('Nginx'))
+            self.assertEqual('/tmp/syslog', conf.get('syslog', 'path'))
+            self.assertEqual('8', conf.get('main', 'workers'))
+
+        self.assertEqual({'a': {'b': 'c=d'}}, overrides.from_args(['a.b=c=d']))
+        self.assertRaises(ValueError, lambda: overrides.from_args(['a=b']))
+        self.assertEqual({'a': {'b': '1'}}, overrides.from_environ('X', {'X__A__B': '1', 'X__C': '2', 'Y__A__B': '3'}))
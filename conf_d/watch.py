@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._watches = {}
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add(self, directory):
+        if directory in self._watches.values():
+            return
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), directory)
+
+        self._watches[wd] = directory
+
+    def read(self, timeout):
+        touched = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return touched
+
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return touched
+            raise
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if wd in self._watches and name:
+                touched.add(os.path.join(self._watches[wd], os.fsdecode(name)))
+
+        return touched
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+
+    def __init__(self, configuration, interval=1.0, debounce=0.1, inotify=None, on_error=None):
+        self._configuration = configuration
+        self._debounce = debounce
+        self._interval = interval
+        self._inotify = None
+        self._on_error = on_error
+        self._subscribers = []
+        self._pending = set()
+        self._generation = None
+        self._directories = set()
+        self._confd_prefixes = ()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        if inotify is None:
+            inotify = sys.platform.startswith('linux')
+
+        if inotify:
+            try:
+                self._inotify = Inotify()
+            except (AttributeError, OSError):
+                self._inotify = None
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def start(self):
+        self._stopped.clear()
+        self._watch()
+        self._thread = threading.Thread(target=self._run, name='conf_d-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def poll(self, timeout=0):
+        self._watch()
+        if self._inotify is None:
+            if timeout:
+                self._stopped.wait(timeout)
+            return self._reload(None)
+
+        touched = self._relevant(self._inotify.read(timeout))
+        if not touched:
+            return []
+
+        while True:
+            more = self._inotify.read(self._debounce)
+            if not more:
+                break
+            touched |= self._relevant(more)
+
+        return self._reload(touched)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.poll(self._interval)
+
+    def _watch(self):
+        if self._inotify is None:
+            return
+
+        # The directories only change with the files a reload published, so
+        # they are collected once per generation rather than on every poll
+        configuration = self._configuration
+        if configuration.generation == self._generation:
+            return
+
+        self._generation = configuration.generation
+        self._confd_prefixes = tuple(os.path.realpath(confd_path) + os.sep for confd_path in configuration._confd_paths())
+        directories = set([os.path.dirname(os.path.realpath(configuration._path))])
+        for confd_path in configuration._confd_paths():
+            directories.add(os.path.realpath(confd_path))
+
+        # Subdirectories of a recursive conf.d are only known once scanned
+        for path in configuration._files:
+            directories.add(os.path.dirname(path))
+
+        for directory in directories - self._directories:
+            try:
+                self._inotify.add(directory)
+            except OSError:
+                pass
+
+        self._directories = directories
+
+    def _relevant(self, touched):
+        main_path = os.path.realpath(self._configuration._path)
+        relevant = set()
+        for path in touched:
+            if path == main_path or os.path.dirname(path) in self._directories or path.startswith(self._confd_prefixes):
+                relevant.add(path)
+
+        return relevant
+
+    def _reload(self, touched):
+        configuration = self._configuration
+        if touched is not None:
+            # Files touched before a failed reload are still to be read
+            touched = touched | self._pending
+
+        try:
+            diff = configuration.reload(paths=touched)
+        except Exception as e:
+            # A file caught half written must not stop the watcher; the
+            # current generation stays published until a reload succeeds
+            if touched is not None:
+                self._pending = touched
+            if self._on_error is not None:
+                self._on_error(e)
+            return []
+
+        self._pending = set()
+
+        events = []
+        for section in diff['added']:
+            events.append(('added', section, configuration.get(section)))
+        for section in diff['changed']:
+            events.append(('changed', section, configuration.get(section)))
+        for section in diff['removed']:
+            events.append(('removed', section, None))
+
+        for event in events:
+            for callback in list(self._subscribers):
+                callback(*event)
+
+        return events